@@ -3,10 +3,22 @@ from __future__ import annotations
 
 
 import json
+import bisect
+import csv
 import heapq
+import random
+import struct
+import sys
+import time
+import tracemalloc
+from array import array
+from collections import OrderedDict
+from concurrent.futures import ProcessPoolExecutor
 from dataclasses import dataclass
+from functools import partial
+from itertools import chain
 from pathlib import Path
-from typing import Dict, List, Optional, Tuple
+from typing import Callable, Dict, Iterable, Iterator, List, Optional, Sequence, Tuple, Union
 
 #______________________________________________
 # Models
@@ -37,13 +49,18 @@ class FareSession:
 # Load Json data 
 # _______________________________________________________
 
-def load_network(data_dir: Path) -> Tuple[
+def load_network(data_dir: Path, compiled: bool = False) -> Tuple[
     Dict[str, Station], 
-    Dict[str, List[Edge]], 
+    Graph, 
     Dict[int, float], 
     float, 
     int
 ]:
+    """
+    Loads stations, connections and fare rules from data_dir.
+    With compiled=True the graph is returned as a CompiledGraph (see compile_graph)
+    instead of the Dict[str, List[Edge]] adjacency lists.
+    """
     stations_path = data_dir / "stations.json"
     edges_path = data_dir / "edges.json"
     fares_path = data_dir / "fares.json"
@@ -76,27 +93,180 @@ def load_network(data_dir: Path) -> Tuple[
     with fares_path.open("r", encoding="utf-8") as f:
         fares = json.load(f)
 
-    zone_fares = {int(k): float(v) for k, v in fares["zone_fares"].items()}
-    bus_flat = float(fares["bus_flat_fare"])
-    transfer_window_minutes = int(fares.get("transfer_window_minutes", 60))
+    zone_fares, bus_flat, transfer_window_minutes = _flat_fares_from_json(fares)
+
+    if compiled:
+        return stations, compile_graph(graph), zone_fares, bus_flat, transfer_window_minutes
     
     return stations, graph, zone_fares, bus_flat, transfer_window_minutes             
 
 
+#_____________________________________________________________________
+# Compiled graph (CSR: compressed sparse rows)
+# ____________________________________________________________________
+
+# Larger than any real travel time; used as "not reached yet" in the int searches
+UNREACHED = 1 << 62
+
+@dataclass
+class CompiledGraph:
+    """
+    Flat, integer-indexed copy of the Dict[str, List[Edge]] graph.
+    Station IDs are interned to dense ints in sorted order (so comparing indexes
+    gives the same tie-breaking as comparing IDs). The edges leaving station i
+    are the slots offsets[i] .. offsets[i + 1] - 1 of the per-edge arrays.
+    """
+    ids: List[str]          # index -> station id
+    index: Dict[str, int]   # station id -> index
+    offsets: array          # len(ids) + 1 entries
+    targets: array          # slot -> index of the station the edge goes to
+    minutes: array          # slot -> travel time
+    line_ids: array         # slot -> index into lines
+    mode_ids: array         # slot -> index into modes
+    rev: array              # slot -> slot of the same connection in the other direction (-1 if none)
+    lines: List[str]
+    modes: List[str]
+    edges: List[Edge]       # slot -> the original Edge object
+    max_minutes: int = 0    # largest edge weight (bucket count for Dial's search)
+
+    def __len__(self) -> int:
+        return len(self.ids)
+
+    def __contains__(self, sid: object) -> bool:
+        return sid in self.index
+
+    def __iter__(self):
+        return iter(self.ids)
+
+    def edges_from(self, sid: str) -> List[Edge]:
+        i = self.index[sid]
+        return self.edges[self.offsets[i]:self.offsets[i + 1]]
+
+
+Graph = Union[Dict[str, List[Edge]], CompiledGraph]
+
+
+def compile_graph(graph: Dict[str, List[Edge]]) -> CompiledGraph:
+    """
+    Builds the CSR form of an adjacency-list graph (as returned by load_network).
+    Edge order inside each station is kept, so searches relax edges in the same order.
+    """
+    ids = sorted(graph)
+    index = {sid: i for i, sid in enumerate(ids)}
+    line_index: Dict[str, int] = {}
+    mode_index: Dict[str, int] = {}
+
+    offsets = array("l", [0])
+    targets = array("l")
+    minutes = array("l")
+    line_ids = array("l")
+    mode_ids = array("l")
+    edges: List[Edge] = []
+
+    for sid in ids:
+        for e in graph[sid]:
+            targets.append(index[e.to_id])
+            minutes.append(e.minutes)
+            line_ids.append(line_index.setdefault(e.line, len(line_index)))
+            mode_ids.append(mode_index.setdefault(e.mode.upper(), len(mode_index)))
+            edges.append(e)
+        offsets.append(len(targets))
+
+    # Pair every a -> b slot with its b -> a twin (link() always adds both)
+    rev = array("l", [-1]) * len(targets)
+    unmatched: Dict[Tuple[int, int, int, int], List[int]] = {}
+    for u in range(len(ids)):
+        for slot in range(offsets[u], offsets[u + 1]):
+            v = targets[slot]
+            twin_key = (v, u, minutes[slot], line_ids[slot])
+            waiting = unmatched.get(twin_key)
+            if waiting:
+                other = waiting.pop()
+                rev[slot] = other
+                rev[other] = slot
+            else:
+                unmatched.setdefault((u, v, minutes[slot], line_ids[slot]), []).append(slot)
+
+    return CompiledGraph(
+        ids = ids,
+        index = index,
+        offsets = offsets,
+        targets = targets,
+        minutes = minutes,
+        line_ids = line_ids,
+        mode_ids = mode_ids,
+        rev = rev,
+        lines = list(line_index),
+        modes = list(mode_index),
+        edges = edges,
+        max_minutes = max(minutes, default = 0),
+    )
+
+
+def _edges_of(graph: Graph, sid: str) -> List[Edge]:
+    if isinstance(graph, CompiledGraph):
+        return graph.edges_from(sid)
+    return graph[sid]
+
+
 #_____________________________________________________________________
 # Routing (Dijkstra: shortest time)
 # ____________________________________________________________________
 
+# Engines selectable through dijkstra_path(..., algorithm=...)
+ROUTING_ALGORITHMS = ("dijkstra", "bidirectional", "dial")
+
 def dijkstra_path(
-    graph: Dict[str, List[Edge]],
+    graph: Graph,
     start_id: str,
-    goal_id: str
+    goal_id: str,
+    algorithm: str = "dijkstra"
 ) -> Optional[Tuple[List[str], int]]:
+    """
+    Shortest route by travel time. Returns (path of station IDs, minutes) or None.
+    algorithm picks the search engine (see ROUTING_ALGORITHMS); all of them
+    return the same minutes, ties between equally fast routes may differ.
+    "bidirectional" and "dial" run on the CSR form: on a dict graph the first query
+    compiles it (O(E), about 40 ms at 10k stations) and later queries on the same
+    dict reuse that. After editing a dict graph in place call forget_compiled(graph).
+    """
+    route = dijkstra_route(graph, start_id, goal_id, algorithm)
+    if route is None:
+        return None
+    path, _, minutes = route
+    return path, minutes
+
+
+def dijkstra_route(
+    graph: Graph,
+    start_id: str,
+    goal_id: str,
+    algorithm: str = "dijkstra"
+) -> Optional[Tuple[List[str], List[Edge], int]]:
+    """
+    Like dijkstra_path, but also returns the Edge the search actually took for each
+    segment: (path, edges, minutes) with edges[i] going path[i] -> path[i + 1].
+    Post-processing the route from these edges needs no edge_info lookups and stays
+    correct when two lines connect the same pair of stations.
+    """
+    if algorithm not in ROUTING_ALGORITHMS:
+        raise ValueError(f"Unknown routing algorithm: {algorithm} (expected one of {ROUTING_ALGORITHMS})")
+
     if start_id not in graph or goal_id not in graph:
         return None;
 
+    if algorithm == "bidirectional":
+        return _bidirectional_route(_as_compiled(graph), start_id, goal_id)
+
+    if algorithm == "dial":
+        return _dial_route(_as_compiled(graph), start_id, goal_id)
+
+    if isinstance(graph, CompiledGraph):
+        return _dijkstra_route_compiled(graph, start_id, goal_id)
+
     dist: Dict[str, int] = {start_id: 0}
     prev: Dict[str, Optional[str]] = {start_id: None}
+    prev_edge: Dict[str, Edge] = {}
     pq: List[Tuple[int, str]] = [(0, start_id)]
 
     visited = set()
@@ -115,6 +285,7 @@ def dijkstra_path(
             if e.to_id not in dist or nd < dist[e.to_id]:
                 dist[e.to_id] = nd
                 prev[e.to_id] = cur
+                prev_edge[e.to_id] = e
                 heapq.heappush(pq, (nd, e.to_id))
 
     if goal_id not in dist:
@@ -123,116 +294,3113 @@ def dijkstra_path(
     # Reconstruct path 
 
     path: List[str] = []
+    edges: List[Edge] = []
     cur: Optional[str] = goal_id
 
     while cur is not None:
         path.append(cur)
+        if cur in prev_edge:
+            edges.append(prev_edge[cur])
         cur = prev.get(cur)
 
     path.reverse()
-    return path, dist[goal_id]
+    edges.reverse()
+    return path, edges, dist[goal_id]
+
+
+def _csr_search(
+    cg: CompiledGraph,
+    source: int,
+    goal: int = -1,
+    stop_after: Optional[Iterable[int]] = None,
+    blocked_nodes: Iterable[int] = (),
+    blocked_slots: Optional[set] = None,
+    max_minutes: int = UNREACHED
+) -> Tuple[List[int], List[int], List[int]]:
+    """
+    Dijkstra over the CSR arrays. Stops once goal is settled, or once every station in
+    stop_after is settled, or once the next station is more than max_minutes away
+    (none given: runs to completion). Stations past max_minutes may keep a tentative dist.
+    blocked_nodes are never expanded and blocked_slots never relaxed (used by k_shortest_routes).
+    Returns (dist, prev, prev_slot) lists indexed by station index;
+    unreached stations keep dist UNREACHED and prev -1.
+    """
+    n = len(cg.ids)
+    offsets, targets, minutes = cg.offsets, cg.targets, cg.minutes
+    dist = [UNREACHED] * n
+    prev = [-1] * n
+    prev_slot = [-1] * n
+    visited = bytearray(n)
+    # Marking a station visited up front means it is never popped and expanded
+    for b in blocked_nodes:
+        visited[b] = 1
+    dist[source] = 0
+    pq: List[Tuple[int, int]] = [(0, source)]
+    heappop, heappush = heapq.heappop, heapq.heappush
+
+    wanted = None
+    remaining = 0
+    if stop_after is not None:
+        wanted = bytearray(n)
+        for t in stop_after:
+            if not wanted[t]:
+                wanted[t] = 1
+                remaining += 1
+
+    while pq:
+        d, u = heappop(pq)
+        if visited[u]:
+            continue
+        if d > max_minutes:
+            break
+        visited[u] = 1
+        if u == goal:
+            break
+        if wanted is not None and wanted[u]:
+            remaining -= 1
+            if remaining == 0:
+                break
+        for slot in range(offsets[u], offsets[u + 1]):
+            if blocked_slots and slot in blocked_slots:
+                continue
+            v = targets[slot]
+            nd = d + minutes[slot]
+            if nd < dist[v]:
+                dist[v] = nd
+                prev[v] = u
+                prev_slot[v] = slot
+                heappush(pq, (nd, v))
+
+    return dist, prev, prev_slot
+
+
+def _csr_path(cg: CompiledGraph, prev: List[int], goal: int) -> List[str]:
+    path: List[str] = []
+    cur = goal
+    while cur != -1:
+        path.append(cg.ids[cur])
+        cur = prev[cur]
+    path.reverse()
+    return path
+
+
+def _csr_route(
+    cg: CompiledGraph,
+    prev: List[int],
+    prev_slot: List[int],
+    goal: int
+) -> Tuple[List[str], List[Edge]]:
+    # Path plus the Edge objects of the tree slots that reached each station
+    path: List[str] = []
+    edges: List[Edge] = []
+    cur = goal
+    while cur != -1:
+        path.append(cg.ids[cur])
+        if prev_slot[cur] != -1:
+            edges.append(cg.edges[prev_slot[cur]])
+        cur = prev[cur]
+    path.reverse()
+    edges.reverse()
+    return path, edges
+
+
+def _dijkstra_route_compiled(
+    cg: CompiledGraph,
+    start_id: str,
+    goal_id: str
+) -> Optional[Tuple[List[str], List[Edge], int]]:
+    goal = cg.index[goal_id]
+    dist, prev, prev_slot = _csr_search(cg, cg.index[start_id], goal)
+    if dist[goal] == UNREACHED:
+        return None
+    path, edges = _csr_route(cg, prev, prev_slot, goal)
+    return path, edges, dist[goal]
+
+
+# Dict graphs compiled by _as_compiled, keyed by object identity (least recently used first).
+# Entries hold the dict itself, so its id can't be reused while it is cached.
+_COMPILED_GRAPHS: "OrderedDict[int, Tuple[Graph, CompiledGraph]]" = OrderedDict()
+COMPILED_GRAPH_CACHE_SIZE = 4
+
+def _as_compiled(graph: Graph) -> CompiledGraph:
+    # The int engines only run on the CSR form. A dict graph is compiled once per object
+    # and reused by later queries; pass a CompiledGraph to skip even the lookup
+    if isinstance(graph, CompiledGraph):
+        return graph
+    hit = _COMPILED_GRAPHS.get(id(graph))
+    if hit is not None and hit[0] is graph:
+        _COMPILED_GRAPHS.move_to_end(id(graph))
+        return hit[1]
+    return _remember_compiled(graph, compile_graph(graph))
+
+
+def _remember_compiled(graph: Graph, cg: CompiledGraph) -> CompiledGraph:
+    _COMPILED_GRAPHS[id(graph)] = (graph, cg)
+    _COMPILED_GRAPHS.move_to_end(id(graph))
+    while len(_COMPILED_GRAPHS) > COMPILED_GRAPH_CACHE_SIZE:
+        _COMPILED_GRAPHS.popitem(last = False)
+    return cg
+
+
+def forget_compiled(graph: Optional[Graph] = None) -> None:
+    """
+    Drops the cached CSR form of a dict graph (or of every graph). Call it after editing
+    a dict graph in place; LiveNetwork does this itself.
+    """
+    if graph is None:
+        _COMPILED_GRAPHS.clear()
+    else:
+        _COMPILED_GRAPHS.pop(id(graph), None)
 
 
 #_______________________________________________________________________
-# Zone Fare logic   
+# Routing (bidirectional Dijkstra)
 # ______________________________________________________________________
-"""
-Fares_zone = {
-    1: 2.50,
-    2: 3.75,
-    3: 4.90,
-}
-"""
 
-def zones_crossed(stations: Dict[str, Station], path: List[str]) -> int:
-    zones = [stations[sid].zone for sid in path]
-    return max(zones) - min(zones) + 1
+def _bidirectional_route(
+    cg: CompiledGraph,
+    start_id: str,
+    goal_id: str
+) -> Optional[Tuple[List[str], List[Edge], int]]:
+    """
+    dijkstra_route(..., algorithm="bidirectional"). Runs one search from the start and
+    one from the goal, always advancing the side with the smaller queue head, and stops
+    once the two heads together cannot beat the best meeting point found so far.
+    The backward search walks the same adjacency lists, which is exact because
+    load_network links every connection in both directions.
+    """
+    if start_id not in cg or goal_id not in cg:
+        return None
 
-#_________________________________________________________________________
-# Helper: infer mode (simple)
-# ________________________________________________________________________
+    start, goal = cg.index[start_id], cg.index[goal_id]
+    if start == goal:
+        return [start_id], [], 0
 
-def infer_mode_for_path(graph: Dict[str, List[Edge]], path: List[str]) -> str:
-    """     
-    If ANY segment is TRAIN, treat the trip as TRAIN (zone-based).
-    Only return BUS if ALL the segments are BUS.
+    n = len(cg.ids)
+    offsets, targets, minutes = cg.offsets, cg.targets, cg.minutes
+    heappop, heappush = heapq.heappop, heapq.heappush
+
+    dist = ([UNREACHED] * n, [UNREACHED] * n)
+    prev = ([-1] * n, [-1] * n)
+    prev_slot = ([-1] * n, [-1] * n)
+    settled = (bytearray(n), bytearray(n))
+    queues: Tuple[List[Tuple[int, int]], List[Tuple[int, int]]] = ([(0, start)], [(0, goal)])
+    dist[0][start] = 0
+    dist[1][goal] = 0
+
+    best = UNREACHED
+    meet = -1
+
+    while queues[0] and queues[1]:
+        if queues[0][0][0] + queues[1][0][0] >= best:
+            break
+
+        side = 0 if queues[0][0][0] <= queues[1][0][0] else 1
+        d_this, d_other = dist[side], dist[1 - side]
+        prev_this, slot_this, done = prev[side], prev_slot[side], settled[side]
+        pq = queues[side]
+
+        d, u = heappop(pq)
+        if done[u]:
+            continue
+        done[u] = 1
+
+        for slot in range(offsets[u], offsets[u + 1]):
+            v = targets[slot]
+            nd = d + minutes[slot]
+            if nd < d_this[v]:
+                d_this[v] = nd
+                prev_this[v] = u
+                slot_this[v] = slot
+                heappush(pq, (nd, v))
+            if d_other[v] != UNREACHED and nd + d_other[v] < best:
+                best = nd + d_other[v]
+                meet = v
+
+    if meet == -1:
+        return None
+
+    path, edges = _csr_route(cg, prev[0], prev_slot[0], meet)
+    # The backward tree walks goal -> meet; take each slot's twin to get the forward Edge
+    cur = meet
+    while prev[1][cur] != -1:
+        slot = prev_slot[1][cur]
+        twin = cg.rev[slot]
+        cur = prev[1][cur]
+        path.append(cg.ids[cur])
+        if twin != -1:
+            edges.append(cg.edges[twin])
+        else:
+            e = cg.edges[slot]
+            edges.append(Edge(cg.ids[cur], e.minutes, e.line, e.mode))
+    return path, edges, best
+
+
+#_______________________________________________________________________
+# Routing (Dial's bucket queue)
+# ______________________________________________________________________
+
+def _dial_search(
+    cg: CompiledGraph,
+    source: int,
+    goal: int = -1
+) -> Tuple[List[int], List[int], List[int]]:
     """
-    if len(path) < 2:
-        return "TRAIN"
-    
-    saw_train = False
-    for a, b in zip(path, path[1: ]):
-        e = edge_info(graph, a, b)
-        if e.mode.upper() == "TRAIN":
-            saw_train = True
+    Same contract as _csr_search, but the priority queue is a ring of max_minutes + 1
+    buckets of plain station ints: with integer weights no larger than C, every queued
+    distance lies within C of the current one, so bucket d % (C + 1) holds exactly the
+    stations at distance d. No heap and no tuple per push.
+    """
+    n = len(cg.ids)
+    offsets, targets, minutes = cg.offsets, cg.targets, cg.minutes
+    dist = [UNREACHED] * n
+    prev = [-1] * n
+    prev_slot = [-1] * n
+    visited = bytearray(n)
+
+    ring = cg.max_minutes + 1
+    buckets: List[List[int]] = [[] for _ in range(ring)]
+    dist[source] = 0
+    buckets[0].append(source)
+    queued = 1
+    d = 0
+
+    while queued:
+        bucket = buckets[d % ring]
+        while not bucket:
+            d += 1
+            bucket = buckets[d % ring]
+
+        # Zero-minute edges append to this same bucket while it is drained
+        while bucket:
+            u = bucket.pop()
+            queued -= 1
+            if visited[u] or dist[u] != d:
+                continue
+            visited[u] = 1
+            if u == goal:
+                return dist, prev, prev_slot
+            for slot in range(offsets[u], offsets[u + 1]):
+                v = targets[slot]
+                nd = d + minutes[slot]
+                if nd < dist[v]:
+                    dist[v] = nd
+                    prev[v] = u
+                    prev_slot[v] = slot
+                    buckets[nd % ring].append(v)
+                    queued += 1
+        d += 1
+
+    return dist, prev, prev_slot
+
+
+def _dial_route(
+    cg: CompiledGraph,
+    start_id: str,
+    goal_id: str
+) -> Optional[Tuple[List[str], List[Edge], int]]:
+    if start_id not in cg or goal_id not in cg:
+        return None
+    goal = cg.index[goal_id]
+    dist, prev, prev_slot = _dial_search(cg, cg.index[start_id], goal)
+    if dist[goal] == UNREACHED:
+        return None
+    path, edges = _csr_route(cg, prev, prev_slot, goal)
+    return path, edges, dist[goal]
+
+
+#_______________________________________________________________________
+# Routing (Contraction Hierarchies)
+# ______________________________________________________________________
+
+@dataclass
+class ContractionHierarchy:
+    """
+    Preprocessed form of the network for fast point-to-point queries.
+    Every station gets a rank (the order it was contracted in). For each station
+    the "upward" edges lead to higher ranked stations; middle is the station a
+    shortcut skips over (-1 for an original connection).
+    Because the network is symmetric, the same upward graph serves both query directions.
+    """
+    ids: List[str]
+    index: Dict[str, int]
+    rank: array
+    up_offsets: array
+    up_targets: array
+    up_minutes: array
+    up_middle: array
+
+
+def _ch_witness_search(
+    adj: List[Dict[int, Tuple[int, int]]],
+    source: int,
+    skip: int,
+    max_cost: int,
+    settle_limit: int
+) -> Dict[int, int]:
+    # Small bounded Dijkstra that ignores the station being contracted
+    dist = {source: 0}
+    pq = [(0, source)]
+    settled = 0
+    while pq and settled < settle_limit:
+        d, u = heapq.heappop(pq)
+        if d > dist[u]:
+            continue
+        if d > max_cost:
+            break
+        settled += 1
+        for v, (w, _) in adj[u].items():
+            if v == skip:
+                continue
+            nd = d + w
+            if nd < dist.get(v, UNREACHED):
+                dist[v] = nd
+                heapq.heappush(pq, (nd, v))
+    return dist
+
+
+def _ch_needed_shortcuts(
+    adj: List[Dict[int, Tuple[int, int]]],
+    v: int,
+    settle_limit: int
+) -> List[Tuple[int, int, int]]:
+    """
+    Shortcuts (u, w, minutes) that must be added when v is removed, i.e. pairs of
+    neighbours whose only shortest connection runs through v.
+    """
+    neighbours = list(adj[v].items())
+    shortcuts = []
+    for i, (u, (w_uv, _)) in enumerate(neighbours):
+        others = neighbours[i + 1:]
+        if not others:
+            continue
+        max_cost = w_uv + max(w_vw for _, (w_vw, _) in others)
+        witness = _ch_witness_search(adj, u, v, max_cost, settle_limit)
+        for w, (w_vw, _) in others:
+            via_v = w_uv + w_vw
+            if witness.get(w, UNREACHED) > via_v:
+                shortcuts.append((u, w, via_v))
+    return shortcuts
+
+
+def build_contraction_hierarchy(graph: Graph, settle_limit: int = 50) -> ContractionHierarchy:
+    """
+    Contracts stations one by one (cheapest first by edge difference: shortcuts added
+    minus edges removed, plus already contracted neighbours), adding a shortcut
+    whenever a bounded witness search cannot find a route around the station.
+    A witness search that gives up early only adds extra shortcuts, never wrong answers.
+    """
+    cg = _as_compiled(graph)
+    n = len(cg.ids)
+
+    # Undirected adjacency keeping only the fastest connection per station pair
+    adj: List[Dict[int, Tuple[int, int]]] = [{} for _ in range(n)]
+    for u in range(n):
+        for slot in range(cg.offsets[u], cg.offsets[u + 1]):
+            v, w = cg.targets[slot], cg.minutes[slot]
+            if v != u and w < adj[u].get(v, (UNREACHED, -1))[0]:
+                adj[u][v] = (w, -1)
+                adj[v][u] = (w, -1)
+
+    deleted_neighbours = [0] * n
+
+    def priority(v: int) -> int:
+        return len(_ch_needed_shortcuts(adj, v, settle_limit)) - len(adj[v]) + deleted_neighbours[v]
+
+    pq = [(priority(v), v) for v in range(n)]
+    heapq.heapify(pq)
+
+    rank = array("l", [0]) * n
+    upward: List[List[Tuple[int, int, int]]] = [[] for _ in range(n)]
+    contracted = bytearray(n)
+    next_rank = 0
+
+    while pq:
+        _, v = heapq.heappop(pq)
+        if contracted[v]:
+            continue
+        # Lazy update: re-evaluate, and put back if something else is now cheaper
+        p = priority(v)
+        if pq and p > pq[0][0]:
+            heapq.heappush(pq, (p, v))
+            continue
+
+        for u, w, cost in _ch_needed_shortcuts(adj, v, settle_limit):
+            if cost < adj[u].get(w, (UNREACHED, -1))[0]:
+                adj[u][w] = (cost, v)
+                adj[w][u] = (cost, v)
+
+        for u, (w, middle) in adj[v].items():
+            upward[v].append((u, w, middle))
+            del adj[u][v]
+            deleted_neighbours[u] += 1
+        adj[v] = {}
+
+        contracted[v] = 1
+        rank[v] = next_rank
+        next_rank += 1
+
+    up_offsets = array("l", [0])
+    up_targets, up_minutes, up_middle = array("l"), array("l"), array("l")
+    for v in range(n):
+        for u, w, middle in upward[v]:
+            up_targets.append(u)
+            up_minutes.append(w)
+            up_middle.append(middle)
+        up_offsets.append(len(up_targets))
+
+    return ContractionHierarchy(
+        ids = list(cg.ids),
+        index = dict(cg.index),
+        rank = rank,
+        up_offsets = up_offsets,
+        up_targets = up_targets,
+        up_minutes = up_minutes,
+        up_middle = up_middle,
+    )
+
+
+def save_contraction_hierarchy(ch: ContractionHierarchy, path: Path) -> None:
+    payload = {
+        "ids": ch.ids,
+        "rank": ch.rank.tolist(),
+        "up_offsets": ch.up_offsets.tolist(),
+        "up_targets": ch.up_targets.tolist(),
+        "up_minutes": ch.up_minutes.tolist(),
+        "up_middle": ch.up_middle.tolist(),
+    }
+    with path.open("w", encoding = "utf-8") as f:
+        json.dump(payload, f, separators = (",", ":"))
+
+
+def load_contraction_hierarchy(path: Path) -> ContractionHierarchy:
+    with path.open("r", encoding = "utf-8") as f:
+        payload = json.load(f)
+
+    ids = payload["ids"]
+    return ContractionHierarchy(
+        ids = ids,
+        index = {sid: i for i, sid in enumerate(ids)},
+        rank = array("l", payload["rank"]),
+        up_offsets = array("l", payload["up_offsets"]),
+        up_targets = array("l", payload["up_targets"]),
+        up_minutes = array("l", payload["up_minutes"]),
+        up_middle = array("l", payload["up_middle"]),
+    )
+
+
+def _ch_settle_next(
+    ch: ContractionHierarchy,
+    dist: Dict[int, int],
+    prev: Dict[int, int],
+    pq: List[Tuple[int, int]],
+    bound: int
+) -> int:
+    # One step of an upward search: settles the queue head, returns it (-1 if stale)
+    d, u = heapq.heappop(pq)
+    if d > dist[u] or d >= bound:
+        return -1
+    for slot in range(ch.up_offsets[u], ch.up_offsets[u + 1]):
+        v = ch.up_targets[slot]
+        nd = d + ch.up_minutes[slot]
+        if nd < dist.get(v, UNREACHED):
+            dist[v] = nd
+            prev[v] = u
+            heapq.heappush(pq, (nd, v))
+    return u
+
+
+def _ch_unpack(ch: ContractionHierarchy, a: int, b: int, out: List[int]) -> None:
+    """
+    Appends the stations strictly after a up to and including b, expanding shortcuts.
+    """
+    stack = [(a, b)]
+    while stack:
+        x, y = stack.pop()
+        # The edge x - y is stored with the lower ranked endpoint
+        low, high = (x, y) if ch.rank[x] < ch.rank[y] else (y, x)
+        middle = -1
+        for slot in range(ch.up_offsets[low], ch.up_offsets[low + 1]):
+            if ch.up_targets[slot] == high:
+                middle = ch.up_middle[slot]
+                break
+        if middle == -1:
+            out.append(y)
+        else:
+            # Process (x, middle) first, so push it last
+            stack.append((middle, y))
+            stack.append((x, middle))
+
+
+def ch_path(
+    ch: ContractionHierarchy,
+    start_id: str,
+    goal_id: str
+) -> Optional[Tuple[List[str], int]]:
+    """
+    Point-to-point query on a contraction hierarchy, same (path, minutes) result as dijkstra_path.
+    Both searches only climb to higher ranked stations; the answer is the best station
+    reached from both sides.
+    """
+    if start_id not in ch.index or goal_id not in ch.index:
+        return None
+
+    start, goal = ch.index[start_id], ch.index[goal_id]
+    if start == goal:
+        return [start_id], 0
+
+    dist = ({start: 0}, {goal: 0})
+    prev: Tuple[Dict[int, int], Dict[int, int]] = ({}, {})
+    queues: Tuple[List[Tuple[int, int]], List[Tuple[int, int]]] = ([(0, start)], [(0, goal)])
+
+    best = UNREACHED
+    meet = -1
+    while queues[0] or queues[1]:
+        heads = [q[0][0] if q else UNREACHED for q in queues]
+        if min(heads) >= best:
+            break
+        side = 0 if heads[0] <= heads[1] else 1
+        u = _ch_settle_next(ch, dist[side], prev[side], queues[side], best)
+        if u == -1:
+            continue
+        d_other = dist[1 - side].get(u)
+        if d_other is not None and dist[side][u] + d_other < best:
+            best = dist[side][u] + d_other
+            meet = u
+
+    if meet == -1:
+        return None
+
+    # Upward chains start -> meet and meet -> goal, then expand the shortcuts
+    stations = [meet]
+    cur = meet
+    while cur != start:
+        cur = prev[0][cur]
+        stations.append(cur)
+    stations.reverse()
+    cur = meet
+    while cur != goal:
+        cur = prev[1][cur]
+        stations.append(cur)
+
+    nodes = [stations[0]]
+    for a, b in zip(stations, stations[1:]):
+        _ch_unpack(ch, a, b, nodes)
+    return [ch.ids[i] for i in nodes], best
+
+
+def verify_contraction_hierarchy(
+    ch: ContractionHierarchy,
+    graph: Graph,
+    pairs: int = 1000,
+    seed: int = 0
+) -> List[Tuple[str, str, Optional[int], Optional[int]]]:
+    """
+    Cross-checks ch_path against dijkstra_path on random origin/destination pairs.
+    Returns the mismatches as (start, goal, dijkstra minutes, ch minutes); empty means OK.
+    A CH route also counts as a mismatch if it does not add up to its minutes on the graph.
+    """
+    rng = random.Random(seed)
+    ids = list(ch.ids)
+    mismatches = []
+    for _ in range(pairs):
+        a, b = rng.choice(ids), rng.choice(ids)
+        expected = dijkstra_path(graph, a, b)
+        got = ch_path(ch, a, b)
+        want_minutes = expected[1] if expected else None
+        got_minutes = got[1] if got else None
+        ok = want_minutes == got_minutes
+        if ok and got is not None:
+            path = got[0]
+            walked = 0
+            for x, y in zip(path, path[1:]):
+                walked += min((e.minutes for e in _edges_of(graph, x) if e.to_id == y), default = UNREACHED)
+            ok = path[0] == a and path[-1] == b and walked == got_minutes
+        if not ok:
+            mismatches.append((a, b, want_minutes, got_minutes))
+    return mismatches
+
+
+#_______________________________________________________________________
+# Routing (A* with landmarks: ALT)
+# ______________________________________________________________________
+
+@dataclass
+class LandmarkIndex:
+    """
+    Distance tables from K landmark stations, used as A* lower bounds.
+    tables[k][v] is the travel time between landmarks[k] and station v
+    (UNREACHED when they are not connected). Memory is K * stations * 8 bytes.
+    """
+    graph: CompiledGraph
+    landmarks: List[int]
+    tables: List[array]
+
+
+def build_landmark_index(graph: Graph, k: int = 8, seed: int = 0) -> LandmarkIndex:
+    """
+    Picks k landmarks by farthest-point selection: the first one at random, then
+    repeatedly the station whose nearest landmark is farthest away (stations not
+    connected to any landmark yet win, so every component gets one).
+    Each table is one full run of the regular Dijkstra search.
+    """
+    cg = _as_compiled(graph)
+    n = len(cg.ids)
+    if n == 0:
+        return LandmarkIndex(cg, [], [])
+
+    rng = random.Random(seed)
+    landmarks: List[int] = []
+    tables: List[array] = []
+    nearest = [UNREACHED] * n
+    candidate = rng.randrange(n)
+
+    for _ in range(min(k, n)):
+        dist, _, _ = _csr_search(cg, candidate)
+        landmarks.append(candidate)
+        tables.append(array("q", dist))
+        for v in range(n):
+            if dist[v] < nearest[v]:
+                nearest[v] = dist[v]
+
+        taken = set(landmarks)
+        candidate = max((v for v in range(n) if v not in taken), key = lambda v: nearest[v], default = -1)
+        if candidate == -1:
+            break
+
+    return LandmarkIndex(cg, landmarks, tables)
+
+
+def alt_path(
+    alt: LandmarkIndex,
+    start_id: str,
+    goal_id: str
+) -> Optional[Tuple[List[str], int]]:
+    """
+    Goal-directed variant of dijkstra_path: the queue is ordered by minutes so far plus
+    a lower bound on the minutes left, max over landmarks L of |d(L, goal) - d(L, v)|
+    (triangle inequality). The bound is consistent, so each station is settled once.
+    """
+    cg = alt.graph
+    if start_id not in cg or goal_id not in cg:
+        return None
+
+    start, goal = cg.index[start_id], cg.index[goal_id]
+    n = len(cg.ids)
+    offsets, targets, minutes = cg.offsets, cg.targets, cg.minutes
+    to_goal = [(table, table[goal]) for table in alt.tables]
+
+    def lower_bound(v: int) -> int:
+        h = 0
+        for table, dg in to_goal:
+            dv = table[v]
+            if (dv == UNREACHED) != (dg == UNREACHED):
+                return UNREACHED # v and the goal are in different components
+            if dv != UNREACHED:
+                gap = dg - dv if dg > dv else dv - dg
+                if gap > h:
+                    h = gap
+        return h
+
+    h_start = lower_bound(start)
+    if h_start == UNREACHED:
+        return None
+
+    dist = [UNREACHED] * n
+    prev = [-1] * n
+    visited = bytearray(n)
+    dist[start] = 0
+    pq: List[Tuple[int, int, int]] = [(h_start, 0, start)]
+    heappop, heappush = heapq.heappop, heapq.heappush
+
+    while pq:
+        _, d, u = heappop(pq)
+        if visited[u]:
+            continue
+        visited[u] = 1
+        if u == goal:
+            break
+        for slot in range(offsets[u], offsets[u + 1]):
+            v = targets[slot]
+            nd = d + minutes[slot]
+            if nd < dist[v]:
+                h = lower_bound(v)
+                if h == UNREACHED:
+                    continue
+                dist[v] = nd
+                prev[v] = u
+                heappush(pq, (nd + h, nd, v))
+
+    if dist[goal] == UNREACHED:
+        return None
+    return _csr_path(cg, prev, goal), dist[goal]
+
+
+#_______________________________________________________________________
+# Precomputed all-pairs travel matrix
+# ______________________________________________________________________
+
+# Set in each pool worker by _init_worker, so the graph is pickled once per process
+_WORKER_GRAPH: Optional[CompiledGraph] = None
+
+def _init_worker(cg: CompiledGraph) -> None:
+    global _WORKER_GRAPH
+    _WORKER_GRAPH = cg
+
+
+def _run_chunk(func: Callable, chunk: list) -> list:
+    return func(_WORKER_GRAPH, chunk)
+
+
+def _map_chunks(
+    cg: CompiledGraph,
+    func: Callable,
+    items: list,
+    workers: Optional[int] = None,
+    chunk_size: int = 16
+) -> list:
+    """
+    Calls func(cg, chunk) over items in chunks and concatenates the results in order.
+    With workers > 1 the chunks run in a process pool; func (and any partial() args)
+    must then be picklable module-level objects.
+    """
+    chunks = [items[i:i + chunk_size] for i in range(0, len(items), chunk_size)]
+    out: list = []
+    if not workers or workers <= 1 or len(chunks) <= 1:
+        for chunk in chunks:
+            out.extend(func(cg, chunk))
+        return out
+
+    with ProcessPoolExecutor(max_workers = workers, initializer = _init_worker, initargs = (cg,)) as pool:
+        for part in pool.map(_run_chunk, [func] * len(chunks), chunks):
+            out.extend(part)
+    return out
+
+
+def _tree_zone_spans(
+    cg: CompiledGraph,
+    zone_of: List[int],
+    prev: List[int],
+    prev_slot: List[int],
+    source: int,
+    only: Optional[Iterable[int]] = None
+) -> Tuple[List[int], List[int], bytearray]:
+    """
+    For every station reached in a shortest-path tree (or just the ones in only):
+    lowest and highest zone on the tree path from source, and whether that path
+    uses a TRAIN segment.
+    Each station is resolved once (walking up to the nearest resolved ancestor).
+    """
+    n = len(cg.ids)
+    lo = [0] * n
+    hi = [0] * n
+    train = bytearray(n)
+    done = bytearray(n)
+    is_train = [m == "TRAIN" for m in cg.modes]
+    mode_ids = cg.mode_ids
+
+    lo[source] = hi[source] = zone_of[source]
+    done[source] = 1
+    for v in (range(n) if only is None else only):
+        if done[v] or prev[v] == -1:
+            continue
+        stack = []
+        cur = v
+        while not done[cur]:
+            stack.append(cur)
+            cur = prev[cur]
+        while stack:
+            cur = stack.pop()
+            p = prev[cur]
+            z = zone_of[cur]
+            lo[cur] = z if z < lo[p] else lo[p]
+            hi[cur] = z if z > hi[p] else hi[p]
+            train[cur] = train[p] or is_train[mode_ids[prev_slot[cur]]]
+            done[cur] = 1
+    return lo, hi, train
+
+
+def _route_fare_cell(
+    source: int,
+    v: int,
+    lo: List[int],
+    hi: List[int],
+    train: bytearray,
+    zone_fares: Dict[int, float],
+    bus_flat_fare: float
+) -> Tuple[int, int, float]:
+    # (zones crossed, required zones, fare) for the tree route source -> v
+    z = hi[v] - lo[v] + 1
+    # Same rule as infer_mode_for_path: the origin itself counts as TRAIN
+    mode = "TRAIN" if (v == source or train[v]) else "BUS"
+    return z, trip_required_zones(mode, z), compute_fare(z, mode, zone_fares, bus_flat_fare)
+
+
+@dataclass
+class TravelMatrix:
+    """
+    All-pairs table, row = origin, column = destination (index o * n + d).
+    minutes is -1 when there is no route; prev[o * n + d] is the station before d
+    on the route from o (-1 for the origin itself and unreachable stations).
+    """
+    ids: List[str]
+    index: Dict[str, int]
+    minutes: array       # 'q'
+    prev: array          # 'l'
+    zones: array         # 'l', zones crossed (route span)
+    required: array      # 'l', fare level after the BUS rule (trip_required_zones)
+    fares: array         # 'd', compute_fare for the route
+
+
+def _matrix_rows(
+    zone_of: List[int],
+    zone_fares: Dict[int, float],
+    bus_flat_fare: float,
+    cg: CompiledGraph,
+    sources: List[int]
+) -> List[Tuple[array, array, array, array, array]]:
+    rows = []
+    n = len(cg.ids)
+    for s in sources:
+        dist, prev, prev_slot = _csr_search(cg, s)
+        lo, hi, train = _tree_zone_spans(cg, zone_of, prev, prev_slot, s)
+        minutes = array("q", [-1]) * n
+        zones = array("l", [0]) * n
+        required = array("l", [0]) * n
+        fares = array("d", [0.0]) * n
+        for v in range(n):
+            if dist[v] == UNREACHED:
+                continue
+            minutes[v] = dist[v]
+            zones[v], required[v], fares[v] = _route_fare_cell(s, v, lo, hi, train, zone_fares, bus_flat_fare)
+        rows.append((minutes, array("l", prev), zones, required, fares))
+    return rows
+
+
+def build_travel_matrix(
+    graph: Graph,
+    stations: Dict[str, Station],
+    zone_fares: Dict[int, float],
+    bus_flat_fare: float,
+    workers: Optional[int] = None
+) -> TravelMatrix:
+    """
+    One full Dijkstra per origin (the same search dijkstra_path uses, so the stored
+    routes are the ones it would return). workers > 1 spreads the origins over a process pool.
+    """
+    cg = _as_compiled(graph)
+    n = len(cg.ids)
+    zone_of = [stations[sid].zone for sid in cg.ids]
+    rows = _map_chunks(
+        cg,
+        partial(_matrix_rows, zone_of, zone_fares, bus_flat_fare),
+        list(range(n)),
+        workers,
+    )
+
+    tm = TravelMatrix(
+        ids = list(cg.ids),
+        index = dict(cg.index),
+        minutes = array("q"),
+        prev = array("l"),
+        zones = array("l"),
+        required = array("l"),
+        fares = array("d"),
+    )
+    for minutes, prev, zones, required, fares in rows:
+        tm.minutes.extend(minutes)
+        tm.prev.extend(prev)
+        tm.zones.extend(zones)
+        tm.required.extend(required)
+        tm.fares.extend(fares)
+    return tm
+
+
+_MATRIX_MAGIC = b"TFSM2\n"
+# (in-memory, on-disk) typecode per TravelMatrix array, in field order. On disk every
+# array is fixed width ('q' 8 bytes, 'i' 4, 'd' 8) and little-endian, whatever the platform
+_MATRIX_TYPES = (("q", "q"), ("l", "i"), ("l", "i"), ("l", "i"), ("d", "d"))
+
+def save_travel_matrix(tm: TravelMatrix, path: Path) -> None:
+    """
+    Binary layout: magic, JSON header (station ids) with its length, then the raw
+    arrays in field order, fixed width and little-endian (see _MATRIX_TYPES).
+    """
+    header = json.dumps({"ids": tm.ids}).encode("utf-8")
+    with path.open("wb") as f:
+        f.write(_MATRIX_MAGIC)
+        f.write(struct.pack("<I", len(header)))
+        f.write(header)
+        for buf, (_, disk) in zip((tm.minutes, tm.prev, tm.zones, tm.required, tm.fares), _MATRIX_TYPES):
+            if buf.typecode != disk or sys.byteorder != "little":
+                buf = array(disk, buf)
+                if sys.byteorder != "little":
+                    buf.byteswap()
+            buf.tofile(f)
+
+
+def load_travel_matrix(path: Path) -> TravelMatrix:
+    with path.open("rb") as f:
+        if f.read(len(_MATRIX_MAGIC)) != _MATRIX_MAGIC:
+            raise ValueError(f"{path} is not a travel matrix file (or was written by an older version)")
+        (header_len,) = struct.unpack("<I", f.read(4))
+        ids = json.loads(f.read(header_len).decode("utf-8"))["ids"]
+        cells = len(ids) * len(ids)
+        buffers = []
+        for memory, disk in _MATRIX_TYPES:
+            buf = array(disk)
+            buf.fromfile(f, cells)
+            if sys.byteorder != "little":
+                buf.byteswap()
+            buffers.append(buf if memory == disk else array(memory, buf))
+
+    minutes, prev, zones, required, fares = buffers
+    return TravelMatrix(
+        ids = ids,
+        index = {sid: i for i, sid in enumerate(ids)},
+        minutes = minutes,
+        prev = prev,
+        zones = zones,
+        required = required,
+        fares = fares,
+    )
+
+
+def matrix_path(tm: TravelMatrix, start_id: str, goal_id: str) -> Optional[Tuple[List[str], int]]:
+    """
+    Same result as dijkstra_path(graph, start_id, goal_id), read from the table.
+    """
+    if start_id not in tm.index or goal_id not in tm.index:
+        return None
+    n = len(tm.ids)
+    row = tm.index[start_id] * n
+    goal = tm.index[goal_id]
+    minutes = tm.minutes[row + goal]
+    if minutes < 0:
+        return None
+
+    path = [goal_id]
+    cur = tm.prev[row + goal]
+    while cur != -1:
+        path.append(tm.ids[cur])
+        cur = tm.prev[row + cur]
+    path.reverse()
+    return path, minutes
+
+
+def matrix_fare(tm: TravelMatrix, start_id: str, goal_id: str) -> Optional[Tuple[int, int, float]]:
+    """
+    (zones crossed, required fare zones, fare) for the stored route, or None if unreachable.
+    """
+    if start_id not in tm.index or goal_id not in tm.index:
+        return None
+    cell = tm.index[start_id] * len(tm.ids) + tm.index[goal_id]
+    if tm.minutes[cell] < 0:
+        return None
+    return tm.zones[cell], tm.required[cell], tm.fares[cell]
+
+
+#_______________________________________________________________________
+# Batch origin-destination matrix
+# ______________________________________________________________________
+
+@dataclass
+class ODMatrixResult:
+    """
+    Columnar results, one entry per requested (origin, destination) pair, in input order.
+    minutes is -1 where no route exists (the other columns are then 0).
+    """
+    origins: List[str]
+    destinations: List[str]
+    minutes: array          # 'q'
+    zones_crossed: array    # 'l'
+    required_zones: array   # 'l'
+    fares: array            # 'd'
+
+    def __len__(self) -> int:
+        return len(self.origins)
+
+
+def _od_origin_batch(
+    zone_of: List[int],
+    zone_fares: Dict[int, float],
+    bus_flat_fare: float,
+    cg: CompiledGraph,
+    groups: List[Tuple[int, List[Tuple[int, int]]]]
+) -> List[Tuple[int, int, int, int, float]]:
+    # groups: (origin, [(position in the request, destination), ...])
+    out = []
+    for s, wanted in groups:
+        dests = [d for _, d in wanted]
+        dist, prev, prev_slot = _csr_search(cg, s, stop_after = dests)
+        lo, hi, train = _tree_zone_spans(cg, zone_of, prev, prev_slot, s, only = dests)
+        for pos, d in wanted:
+            if dist[d] == UNREACHED:
+                out.append((pos, -1, 0, 0, 0.0))
+            else:
+                out.append((pos, dist[d]) + _route_fare_cell(s, d, lo, hi, train, zone_fares, bus_flat_fare))
+    return out
+
+
+def batch_od_matrix(
+    graph: Graph,
+    stations: Dict[str, Station],
+    zone_fares: Dict[int, float],
+    bus_flat_fare: float,
+    pairs: Sequence[Tuple[str, str]],
+    workers: Optional[int] = None
+) -> ODMatrixResult:
+    """
+    Travel time, zones crossed, required zones and fare for many OD pairs.
+    Pairs are grouped by origin and each origin gets one single-source search that
+    stops as soon as all of its destinations are settled. workers > 1 spreads the
+    origins over a process pool. Unknown station IDs are reported as unreachable.
+    """
+    cg = _as_compiled(graph)
+    zone_of = [stations[sid].zone for sid in cg.ids]
+
+    by_origin: Dict[int, List[Tuple[int, int]]] = {}
+    n_pairs = len(pairs)
+    minutes = array("q", [-1]) * n_pairs
+    zones = array("l", [0]) * n_pairs
+    required = array("l", [0]) * n_pairs
+    fares = array("d", [0.0]) * n_pairs
+
+    for pos, (a, b) in enumerate(pairs):
+        if a in cg.index and b in cg.index:
+            by_origin.setdefault(cg.index[a], []).append((pos, cg.index[b]))
+
+    cells = _map_chunks(
+        cg,
+        partial(_od_origin_batch, zone_of, zone_fares, bus_flat_fare),
+        list(by_origin.items()),
+        workers,
+    )
+    for pos, m, z, req, fare in cells:
+        minutes[pos] = m
+        zones[pos] = z
+        required[pos] = req
+        fares[pos] = fare
+
+    return ODMatrixResult(
+        origins = [a for a, _ in pairs],
+        destinations = [b for _, b in pairs],
+        minutes = minutes,
+        zones_crossed = zones,
+        required_zones = required,
+        fares = fares,
+    )
+
+
+#_______________________________________________________________________
+# Isochrones / reachability
+# ______________________________________________________________________
+
+@dataclass(slots = True)
+class ReachableStation:
+    station_id: str
+    minutes: int
+    zones_crossed: int
+    fare: float         # compute_fare for the fastest route
+
+
+def _isochrone_rows(
+    zone_of: List[int],
+    zone_fares: Dict[int, float],
+    bus_flat_fare: float,
+    max_minutes: int,
+    fare_budget: Optional[float],
+    cg: CompiledGraph,
+    origins: List[int]
+) -> List[List[ReachableStation]]:
+    rows = []
+    for s in origins:
+        dist, prev, prev_slot = _csr_search(cg, s, max_minutes = max_minutes)
+        inside = [v for v in range(len(cg.ids)) if dist[v] <= max_minutes]
+        lo, hi, train = _tree_zone_spans(cg, zone_of, prev, prev_slot, s, only = inside)
+        row = []
+        for v in inside:
+            zones, _, fare = _route_fare_cell(s, v, lo, hi, train, zone_fares, bus_flat_fare)
+            if fare_budget is None or fare <= fare_budget:
+                row.append(ReachableStation(cg.ids[v], dist[v], zones, fare))
+        row.sort(key = lambda r: (r.minutes, r.station_id))
+        rows.append(row)
+    return rows
+
+
+def isochrone(
+    graph: Graph,
+    stations: Dict[str, Station],
+    zone_fares: Dict[int, float],
+    bus_flat_fare: float,
+    origin_id: str,
+    max_minutes: int,
+    fare_budget: Optional[float] = None
+) -> List[ReachableStation]:
+    """
+    Every station reachable from origin_id within max_minutes (the origin included),
+    nearest first. One search that stops at the time limit; with fare_budget, stations
+    whose fastest route costs more than the budget are left out.
+    """
+    if origin_id not in graph:
+        return []
+    cg = _as_compiled(graph)
+    zone_of = [stations[sid].zone for sid in cg.ids]
+    return _isochrone_rows(zone_of, zone_fares, bus_flat_fare, max_minutes, fare_budget, cg, [cg.index[origin_id]])[0]
+
+
+def all_isochrones(
+    graph: Graph,
+    stations: Dict[str, Station],
+    zone_fares: Dict[int, float],
+    bus_flat_fare: float,
+    max_minutes: int,
+    fare_budget: Optional[float] = None,
+    workers: Optional[int] = None
+) -> Dict[str, List[ReachableStation]]:
+    """
+    isochrone() from every station, optionally spread over a process pool.
+    """
+    cg = _as_compiled(graph)
+    zone_of = [stations[sid].zone for sid in cg.ids]
+    rows = _map_chunks(
+        cg,
+        partial(_isochrone_rows, zone_of, zone_fares, bus_flat_fare, max_minutes, fare_budget),
+        list(range(len(cg.ids))),
+        workers,
+    )
+    return dict(zip(cg.ids, rows))
+
+
+#_______________________________________________________________________
+# Betweenness centrality (which stations and segments carry the most routes)
+# ______________________________________________________________________
+
+@dataclass(slots = True)
+class Betweenness:
+    """
+    Brandes betweenness over all ordered origin/destination pairs. When several routes
+    tie for fastest, each gets an equal share of the pair. Edge scores are per directed
+    edge, indexed by compiled slot (edges[slot] is the matching Edge).
+    """
+    ids: List[str]
+    stations: array    # 'd', per station
+    edge_from: List[str]
+    edges: List[Edge]
+    edge_scores: array # 'd', per slot
+
+    def station_score(self, station_id: str) -> float:
+        return self.stations[self.ids.index(station_id)]
+
+    def top_edges(self, n: int = 10) -> List[Tuple[str, Edge, float]]:
+        order = sorted(range(len(self.edges)), key = lambda slot: -self.edge_scores[slot])
+        return [(self.edge_from[slot], self.edges[slot], self.edge_scores[slot]) for slot in order[:n]]
+
+
+def _slot_owners(cg: CompiledGraph) -> array:
+    # slot -> station the edge leaves from
+    owner = array("l", [0]) * len(cg.targets)
+    for u in range(len(cg.ids)):
+        for slot in range(cg.offsets[u], cg.offsets[u + 1]):
+            owner[slot] = u
+    return owner
+
+
+def _brandes_chunk(cg: CompiledGraph, sources: List[int]) -> List[Tuple[array, array]]:
+    # One partial (station, edge) sum per chunk keeps the pool's return traffic small
+    n = len(cg.ids)
+    offsets, targets, minutes = cg.offsets, cg.targets, cg.minutes
+    node_sum = array("d", [0.0]) * n
+    edge_sum = array("d", [0.0]) * len(targets)
+    owner = _slot_owners(cg)
+
+    for s in sources:
+        dist = [UNREACHED] * n
+        sigma = [0.0] * n
+        preds: List[List[int]] = [[] for _ in range(n)]   # slots into each station on a fastest route
+        order = []
+        done = [False] * n
+        dist[s] = 0
+        sigma[s] = 1.0
+        heap = [(0, s)]
+        while heap:
+            d, u = heapq.heappop(heap)
+            if done[u]:
+                continue
+            done[u] = True
+            order.append(u)
+            for slot in range(offsets[u], offsets[u + 1]):
+                v = targets[slot]
+                nd = d + minutes[slot]
+                if nd < dist[v]:
+                    dist[v] = nd
+                    sigma[v] = sigma[u]
+                    preds[v] = [slot]
+                    heapq.heappush(heap, (nd, v))
+                elif nd == dist[v] and not done[v]:
+                    sigma[v] += sigma[u]
+                    preds[v].append(slot)
+
+        # Walk back from the farthest station, handing each one's dependency to its predecessors
+        delta = [0.0] * n
+        for w in reversed(order):
+            share = (1.0 + delta[w]) / sigma[w]
+            for slot in preds[w]:
+                u = owner[slot]
+                c = sigma[u] * share
+                edge_sum[slot] += c
+                delta[u] += c
+            if w != s:
+                node_sum[w] += delta[w]
+    return [(node_sum, edge_sum)]
+
+
+def betweenness_centrality(
+    graph: Graph,
+    normalized: bool = False,
+    workers: Optional[int] = None,
+    chunk_size: int = 64
+) -> Betweenness:
+    """
+    Station and edge betweenness (Brandes), one search per origin. Origins are spread over
+    a process pool with workers > 1 and the partial sums are added up afterwards.
+    Travel times must be positive; with normalized, scores are divided by the number of
+    ordered pairs that could use the station ((n-1)(n-2)) or edge (n(n-1)).
+    """
+    cg = _as_compiled(graph)
+    n = len(cg.ids)
+    stations = array("d", [0.0]) * n
+    edge_scores = array("d", [0.0]) * len(cg.targets)
+    for node_sum, edge_sum in _map_chunks(cg, _brandes_chunk, list(range(n)), workers, chunk_size):
+        for v in range(n):
+            stations[v] += node_sum[v]
+        for slot in range(len(edge_sum)):
+            edge_scores[slot] += edge_sum[slot]
+
+    if normalized and n > 2:
+        scale = 1.0 / ((n - 1) * (n - 2))
+        for v in range(n):
+            stations[v] *= scale
+    if normalized and n > 1:
+        scale = 1.0 / (n * (n - 1))
+        for slot in range(len(edge_scores)):
+            edge_scores[slot] *= scale
+
+    edge_from = [cg.ids[u] for u in _slot_owners(cg)]
+    return Betweenness(list(cg.ids), stations, edge_from, list(cg.edges), edge_scores)
+
+
+def save_betweenness_csv(result: Betweenness, stations_path: Path, edges_path: Path) -> None:
+    """
+    Two CSV files, highest score first: station_id,score and from_id,to_id,line,mode,minutes,score.
+    """
+    with stations_path.open("w", newline = "") as f:
+        out = csv.writer(f)
+        out.writerow(["station_id", "score"])
+        for v in sorted(range(len(result.ids)), key = lambda v: -result.stations[v]):
+            out.writerow([result.ids[v], result.stations[v]])
+
+    with edges_path.open("w", newline = "") as f:
+        out = csv.writer(f)
+        out.writerow(["from_id", "to_id", "line", "mode", "minutes", "score"])
+        for a, e, score in result.top_edges(len(result.edges)):
+            out.writerow([a, e.to_id, e.line, e.mode, e.minutes, score])
+
+
+#_______________________________________________________________________
+# Shortest-path tree cache
+# ______________________________________________________________________
+
+@dataclass(slots = True)
+class ShortestPathTree:
+    """
+    Full single-source result from one origin. dist is UNREACHED for stations that
+    cannot be reached; prev / prev_slot are -1 there and at the origin.
+    """
+    origin: int
+    dist: array        # 'q'
+    prev: array        # 'l'
+    prev_slot: array   # 'l'
+
+    def nbytes(self) -> int:
+        return sum(len(buf) * buf.itemsize for buf in (self.dist, self.prev, self.prev_slot))
+
+
+def shortest_path_tree(cg: CompiledGraph, origin: int) -> ShortestPathTree:
+    dist, prev, prev_slot = _csr_search(cg, origin)
+    return ShortestPathTree(origin, array("q", dist), array("l", prev), array("l", prev_slot))
+
+
+class ShortestPathTreeCache:
+    """
+    LRU cache of shortest-path trees keyed by origin, so repeated queries from busy
+    origins are just a walk up the tree (same route dijkstra_path returns).
+    Bounded by max_trees and, optionally, max_bytes of tree arrays.
+    The cache remembers the graph it was filled from: passing a different graph object
+    (e.g. after load_network ran again) empties it. Call invalidate() after changing a
+    graph in place.
+    """
+
+    def __init__(self, max_trees: int = 64, max_bytes: Optional[int] = None) -> None:
+        self.max_trees = max_trees
+        self.max_bytes = max_bytes
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.nbytes = 0
+        self._trees: "OrderedDict[int, ShortestPathTree]" = OrderedDict()
+        self._source: Optional[Graph] = None
+        self._compiled: Optional[CompiledGraph] = None
+
+    def __len__(self) -> int:
+        return len(self._trees)
+
+    def invalidate(self) -> None:
+        self._trees.clear()
+        self.nbytes = 0
+        self._source = None
+        self._compiled = None
+
+    def compiled(self, graph: Graph) -> CompiledGraph:
+        """
+        The CSR form of graph, compiled once per graph object. Switching to another
+        graph drops every cached tree.
+        """
+        if graph is not self._source or self._compiled is None:
+            self.invalidate()
+            self._source = graph
+            self._compiled = _as_compiled(graph)
+        return self._compiled
+
+    def repair(
+        self,
+        graph: Graph,
+        cg: CompiledGraph,
+        is_stale: Callable[[ShortestPathTree], bool]
+    ) -> List[int]:
+        """
+        Moves the cache to an edited version of its network (graph, compiled as cg)
+        without starting over: trees for which is_stale(tree) holds (checked against the
+        previous compiled graph) are recomputed on cg, the others only have their edge
+        slots renumbered. Stations must be unchanged. Returns the recomputed origins.
+        """
+        old = self._compiled
+        self._source = graph
+        self._compiled = cg
+        if old is None:
+            return []
+
+        new_slot = {id(e): slot for slot, e in enumerate(cg.edges)}
+        recomputed = []
+        for origin, spt in list(self._trees.items()):
+            if is_stale(spt):
+                fresh = shortest_path_tree(cg, origin)
+                self.nbytes += fresh.nbytes() - spt.nbytes()
+                self._trees[origin] = fresh
+                recomputed.append(origin)
+            else:
+                spt.prev_slot = array("l", [new_slot[id(old.edges[slot])] if slot != -1 else -1 for slot in spt.prev_slot])
+        return recomputed
+
+    def tree(self, graph: Graph, origin_id: str) -> ShortestPathTree:
+        cg = self.compiled(graph)
+        origin = cg.index[origin_id]
+
+        cached = self._trees.get(origin)
+        if cached is not None:
+            self.hits += 1
+            self._trees.move_to_end(origin)
+            return cached
+
+        self.misses += 1
+        spt = shortest_path_tree(cg, origin)
+        self._trees[origin] = spt
+        self.nbytes += spt.nbytes()
+        self._shrink()
+        return spt
+
+    def _shrink(self) -> None:
+        # Always keep the newest tree, even if it alone is over max_bytes
+        while len(self._trees) > 1 and (
+            len(self._trees) > self.max_trees
+            or (self.max_bytes is not None and self.nbytes > self.max_bytes)
+        ):
+            _, old = self._trees.popitem(last = False)
+            self.nbytes -= old.nbytes()
+            self.evictions += 1
+
+    def route(
+        self,
+        graph: Graph,
+        start_id: str,
+        goal_id: str
+    ) -> Optional[Tuple[List[str], List[Edge], int]]:
+        """
+        Same result as dijkstra_route(graph, start_id, goal_id), served from the cached tree.
+        """
+        if start_id not in graph or goal_id not in graph:
+            return None
+        spt = self.tree(graph, start_id)
+        cg = self._compiled
+        goal = cg.index[goal_id]
+        if spt.dist[goal] == UNREACHED:
+            return None
+        path, edges = _csr_route(cg, spt.prev, spt.prev_slot, goal)
+        return path, edges, spt.dist[goal]
+
+    def stats(self) -> Dict[str, int]:
+        return {
+            "trees": len(self._trees),
+            "bytes": self.nbytes,
+            "hits": self.hits,
+            "misses": self.misses,
+            "evictions": self.evictions,
+        }
+
+
+#_______________________________________________________________________
+# Expected waits from line headways
+# ______________________________________________________________________
+"""
+fares.json can declare service frequency:
+    "time_bands": {"peak_am": ["06:30","09:30"], ...}     (start inclusive, end exclusive)
+    "headways": {"default": 15, "Expo": {"peak_am": 3, "default": 6}, ...}
+A line's headway in a band falls back to its "default", then to the top-level "default".
+Minutes not covered by any band use the "default" band.
+"""
+
+@dataclass
+class WaitTable:
+    """
+    Expected wait (half the headway, riders turning up at random) per (line, time band),
+    precomputed so a lookup is two array reads. Line ids are those of the CompiledGraph.
+    """
+    lines: List[str]
+    bands: List[str]
+    band_of_minute: array   # minute of day (0..1439) -> band index
+    waits: array            # line_id * len(bands) + band -> expected wait in minutes
+
+    def wait(self, line_id: int, minute: int) -> float:
+        return self.waits[line_id * len(self.bands) + self.band_of_minute[minute % 1440]]
+
+
+def _band_of_minute(time_bands: Dict[str, List[str]]) -> Tuple[List[str], array]:
+    # Band names ("default" first) and minute of day -> band index
+    bands = ["default"] + [name for name in time_bands if name != "default"]
+    band_of_minute = array("B", [0]) * 1440
+    for b, name in enumerate(bands):
+        if name not in time_bands:
+            continue
+        start, end = (parse_service_minute(t) for t in time_bands[name])
+        for minute in range(start, end if end > start else end + 1440):
+            band_of_minute[minute % 1440] = b
+    return bands, band_of_minute
+
+
+def build_wait_table(
+    lines: List[str],
+    time_bands: Dict[str, List[str]],
+    headways: Dict[str, Union[int, Dict[str, int]]]
+) -> WaitTable:
+    bands, band_of_minute = _band_of_minute(time_bands)
+
+    def headway(line: str, band: str) -> Optional[float]:
+        for source in (headways.get(line), headways.get("default")):
+            if isinstance(source, dict):
+                if band in source:
+                    return float(source[band])
+                if "default" in source:
+                    return float(source["default"])
+            elif source is not None:
+                return float(source)
+        return None
+
+    waits = array("d")
+    for line in lines:
+        for band in bands:
+            h = headway(line, band)
+            waits.append(h / 2 if h else 0.0)
+
+    return WaitTable(list(lines), bands, band_of_minute, waits)
+
+
+def load_wait_table(data_dir: Path, graph: Graph) -> WaitTable:
+    """
+    Reads time_bands / headways from fares.json for the lines of graph.
+    Without a headways block every wait is 0.
+    """
+    with (data_dir / "fares.json").open("r", encoding = "utf-8") as f:
+        fares = json.load(f)
+    return build_wait_table(
+        _as_compiled(graph).lines,
+        fares.get("time_bands", {}),
+        fares.get("headways", {}),
+    )
+
+
+def expected_wait_minutes(
+    cg: CompiledGraph,
+    waits: WaitTable,
+    edges: List[Edge],
+    depart_minute: int
+) -> float:
+    """
+    Expected waiting on a route: the first boarding plus every line change, each looked
+    up in the band of the minute the rider gets there.
+    """
+    total = 0.0
+    clock = depart_minute
+    line_id = {line: i for i, line in enumerate(cg.lines)}
+    last_line = None
+    for e in edges:
+        if e.line != last_line:
+            w = waits.wait(line_id[e.line], clock)
+            total += w
+            clock += int(w)
+            last_line = e.line
+        clock += e.minutes
+    return total
+
+
+#_______________________________________________________________________
+# Line-aware routing (state = station + line, with transfer penalties)
+# ______________________________________________________________________
+
+@dataclass
+class LineGraph:
+    """
+    Expanded graph built once from a CompiledGraph: one node per (station, line serving
+    it). Ride edges keep their line; transfer edges join the nodes of one station and
+    cost the transfer penalty. Nodes of station s are station_offsets[s] .. station_offsets[s + 1] - 1.
+    """
+    graph: CompiledGraph
+    station_offsets: array  # station -> first expanded node
+    node_station: array     # expanded node -> station index
+    node_line: array        # expanded node -> line id
+    offsets: array          # CSR over expanded nodes
+    targets: array
+    costs: array            # ride minutes, or the transfer penalty
+    slots: array            # original CompiledGraph slot for ride edges, -1 for transfers
+
+
+def build_line_graph(
+    graph: Graph,
+    transfer_penalty: int = 5,
+    station_penalties: Optional[Dict[str, int]] = None,
+    line_pair_penalties: Optional[Dict[Tuple[str, str], int]] = None
+) -> LineGraph:
+    """
+    Transfer cost from line A to line B at station s: line_pair_penalties[(A, B)]
+    (or (B, A)), else station_penalties[s], else transfer_penalty.
+    """
+    cg = _as_compiled(graph)
+    n = len(cg.ids)
+    station_penalties = station_penalties or {}
+    line_pair_penalties = line_pair_penalties or {}
+
+    station_offsets = array("l", [0])
+    node_station, node_line = array("l"), array("l")
+    node_of: Dict[Tuple[int, int], int] = {}
+    for s in range(n):
+        for line in sorted({cg.line_ids[slot] for slot in range(cg.offsets[s], cg.offsets[s + 1])}):
+            node_of[(s, line)] = len(node_station)
+            node_station.append(s)
+            node_line.append(line)
+        station_offsets.append(len(node_station))
+
+    def penalty(s: int, a: int, b: int) -> int:
+        la, lb = cg.lines[a], cg.lines[b]
+        if (la, lb) in line_pair_penalties:
+            return line_pair_penalties[(la, lb)]
+        if (lb, la) in line_pair_penalties:
+            return line_pair_penalties[(lb, la)]
+        return station_penalties.get(cg.ids[s], transfer_penalty)
+
+    offsets = array("l", [0])
+    targets, costs, slots = array("l"), array("l"), array("l")
+    for x in range(len(node_station)):
+        s, line = node_station[x], node_line[x]
+        for slot in range(cg.offsets[s], cg.offsets[s + 1]):
+            if cg.line_ids[slot] == line:
+                targets.append(node_of[(cg.targets[slot], line)])
+                costs.append(cg.minutes[slot])
+                slots.append(slot)
+        for y in range(station_offsets[s], station_offsets[s + 1]):
+            if y != x:
+                targets.append(y)
+                costs.append(penalty(s, line, node_line[y]))
+                slots.append(-1)
+        offsets.append(len(targets))
+
+    return LineGraph(cg, station_offsets, node_station, node_line, offsets, targets, costs, slots)
+
+
+def line_aware_route(
+    lg: LineGraph,
+    start_id: str,
+    goal_id: str,
+    waits: Optional[WaitTable] = None,
+    depart_minute: int = 0
+) -> Optional[Tuple[List[str], List[Edge], int]]:
+    """
+    Cheapest route when every line change costs its transfer penalty.
+    With a WaitTable, boarding the first line and every line changed to also costs the
+    expected wait for that line in the time band of the (estimated) boarding time,
+    depart_minute plus the cost so far.
+    Same (path, edges, minutes) shape as dijkstra_route; minutes is travel time only,
+    penalties and waits only steer the choice (see expected_wait_minutes).
+    """
+    cg = lg.graph
+    if start_id not in cg or goal_id not in cg:
+        return None
+    start, goal = cg.index[start_id], cg.index[goal_id]
+    if start == goal:
+        return [start_id], [], 0
+
+    n = len(lg.node_station)
+    offsets, targets, costs = lg.offsets, lg.targets, lg.costs
+    dist = [UNREACHED] * n
+    prev = [-1] * n        # expanded node we came from
+    prev_edge = [-1] * n   # expanded edge we came over
+    visited = bytearray(n)
+    node_line, slots = lg.node_line, lg.slots
+    pq: List[Tuple[float, int]] = []
+    # Boarding any line at the start costs nothing but its wait
+    for x in range(lg.station_offsets[start], lg.station_offsets[start + 1]):
+        dist[x] = waits.wait(node_line[x], depart_minute) if waits is not None else 0
+        pq.append((dist[x], x))
+    heapq.heapify(pq)
+
+    reached = -1
+    while pq:
+        d, x = heapq.heappop(pq)
+        if visited[x]:
+            continue
+        visited[x] = 1
+        if lg.node_station[x] == goal:
+            reached = x
+            break
+        for k in range(offsets[x], offsets[x + 1]):
+            y = targets[k]
+            nd = d + costs[k]
+            if waits is not None and slots[k] == -1:
+                nd += waits.wait(node_line[y], depart_minute + int(d))
+            if nd < dist[y]:
+                dist[y] = nd
+                prev[y] = x
+                prev_edge[y] = k
+                heapq.heappush(pq, (nd, y))
+
+    if reached == -1:
+        return None
+
+    # Walk back over expanded edges; transfer edges add no segment
+    ride_slots: List[int] = []
+    x = reached
+    while prev[x] != -1:
+        slot = lg.slots[prev_edge[x]]
+        if slot != -1:
+            ride_slots.append(slot)
+        x = prev[x]
+    ride_slots.reverse()
+
+    path = [start_id] + [cg.ids[cg.targets[slot]] for slot in ride_slots]
+    edges = [cg.edges[slot] for slot in ride_slots]
+    return path, edges, sum(e.minutes for e in edges)
+
+
+#_______________________________________________________________________
+# Passenger assignment (all-or-nothing)
+# ______________________________________________________________________
+
+@dataclass(slots = True)
+class Assignment:
+    """
+    Result of loading OD demand onto fastest routes. loads is per directed edge,
+    indexed by compiled slot like Betweenness. A boarding is counted wherever a trip
+    starts riding a line, i.e. at its first edge and at every line change.
+    """
+    ids: List[str]
+    edge_from: List[str]
+    edges: List[Edge]
+    loads: array                        # 'd', passengers per slot
+    line_boardings: Dict[str, float]
+    revenue: float                      # fare_for_zones(required zones) * trips
+    assigned_trips: float
+    unassigned_trips: float             # no route, or unknown station
+
+    def busiest_segments(self, n: int = 10) -> List[Tuple[str, Edge, float]]:
+        order = sorted(range(len(self.edges)), key = lambda slot: -self.loads[slot])
+        return [(self.edge_from[slot], self.edges[slot], self.loads[slot]) for slot in order[:n]]
+
+
+def assign_demand(
+    graph: Graph,
+    stations: Dict[str, Station],
+    zone_fares: Dict[int, float],
+    demand: Dict[Tuple[str, str], float],
+    cache: Optional[ShortestPathTreeCache] = None
+) -> Assignment:
+    """
+    All-or-nothing assignment: every OD flow goes on the fastest route (the one
+    dijkstra_path returns). One shortest-path tree per origin (taken from cache if given);
+    the origin's flows are then pushed up the tree leaves-first, so each edge gets the
+    sum of everything routed below it in one pass instead of one walk per pair.
+    """
+    cg = cache.compiled(graph) if cache is not None else _as_compiled(graph)
+    n = len(cg.ids)
+    zone_of = [stations[sid].zone for sid in cg.ids]
+    line_ids = cg.line_ids
+    loads = array("d", [0.0]) * len(cg.targets)
+    boarded = [0.0] * len(cg.lines)
+    revenue = 0.0
+    assigned = 0.0
+    unassigned = 0.0
+
+    by_origin: Dict[int, Dict[int, float]] = {}
+    for (a, b), trips in demand.items():
+        if a not in cg.index or b not in cg.index:
+            unassigned += trips
+        elif a != b:
+            row = by_origin.setdefault(cg.index[a], {})
+            row[cg.index[b]] = row.get(cg.index[b], 0.0) + trips
+
+    for s, row in by_origin.items():
+        spt = cache.tree(graph, cg.ids[s]) if cache is not None else shortest_path_tree(cg, s)
+        prev, prev_slot = spt.prev, spt.prev_slot
+        lo, hi, train = _tree_zone_spans(cg, zone_of, prev, prev_slot, s, only = row)
+
+        flow = [0.0] * n
+        for d, trips in row.items():
+            if spt.dist[d] == UNREACHED:
+                unassigned += trips
+                continue
+            flow[d] = trips
+            assigned += trips
+            mode = "TRAIN" if train[d] else "BUS"
+            required = trip_required_zones(mode, hi[d] - lo[d] + 1)
+            revenue += trips * fare_for_zones(required, zone_fares)
+
+        # Parents before children (breadth-first down the tree), then sweep it backwards
+        children: List[List[int]] = [[] for _ in range(n)]
+        for v in range(n):
+            if prev[v] != -1:
+                children[prev[v]].append(v)
+        order = [s]
+        for u in order:
+            order.extend(children[u])
+
+        for v in reversed(order):
+            if v == s or flow[v] == 0.0:
+                continue
+            slot = prev_slot[v]
+            u = prev[v]
+            loads[slot] += flow[v]
+            flow[u] += flow[v]
+            # Boarding unless the trip already rode this line into u
+            if u == s or line_ids[prev_slot[u]] != line_ids[slot]:
+                boarded[line_ids[slot]] += flow[v]
+
+    return Assignment(
+        ids = list(cg.ids),
+        edge_from = [cg.ids[u] for u in _slot_owners(cg)],
+        edges = list(cg.edges),
+        loads = loads,
+        line_boardings = {line: boarded[i] for i, line in enumerate(cg.lines) if boarded[i]},
+        revenue = revenue,
+        assigned_trips = assigned,
+        unassigned_trips = unassigned,
+    )
+
+
+#_______________________________________________________________________
+# Live network edits (disruptions, shuttle buses)
+# ______________________________________________________________________
+
+class LiveNetwork:
+    """
+    A loaded network that can be edited while the planner runs: close a connection,
+    add a shuttle, change a travel time. Connections stay two-way, like load_network's link().
+    After each edit only the cached shortest-path trees and tracked TravelMatrix rows whose
+    origin can see the change are recomputed:
+    - slower / removed connection: origins whose tree uses it
+    - faster / new connection: origins for which it is at least as fast as the current route
+      to one of its ends
+    Landmark and contraction-hierarchy indexes are not tracked; rebuild them after edits.
+    """
+
+    def __init__(
+        self,
+        stations: Dict[str, Station],
+        graph: Dict[str, List[Edge]],
+        zone_fares: Dict[int, float],
+        bus_flat_fare: float,
+        cache: Optional[ShortestPathTreeCache] = None
+    ) -> None:
+        self.stations = stations
+        self.graph = graph
+        self.zone_fares = zone_fares
+        self.bus_flat_fare = bus_flat_fare
+        self.cache = cache if cache is not None else ShortestPathTreeCache()
+        self.compiled = _remember_compiled(graph, compile_graph(graph))
+        self.version = 0
+        self.matrices: List[TravelMatrix] = []
+        self.cache.repair(graph, self.compiled, lambda spt: True)
+
+    def route(self, start_id: str, goal_id: str) -> Optional[RouteResult]:
+        route = self.cache.route(self.graph, start_id, goal_id)
+        if route is None:
+            return None
+        return annotate_route(self.stations, *route)
+
+    def track_matrix(self, tm: TravelMatrix) -> None:
+        """
+        Keeps a TravelMatrix built from this network up to date on every edit.
+        """
+        if tm.ids != self.compiled.ids:
+            raise ValueError("Travel matrix was built for a different set of stations")
+        self.matrices.append(tm)
+
+    def _find(self, a: str, b: str, line: Optional[str]) -> Tuple[int, int]:
+        # Positions of the a -> b edge in graph[a] and of its twin in graph[b]
+        for sid in (a, b):
+            if sid not in self.graph:
+                raise ValueError(f"Unknown station: {sid}")
+        forward = [i for i, e in enumerate(self.graph[a]) if e.to_id == b and (line is None or e.line == line)]
+        if not forward:
+            raise ValueError(f"No connection {a} -> {b}" + (f" on {line}" if line else ""))
+        if len(forward) > 1:
+            raise ValueError(f"Several lines connect {a} and {b}; pass line= to pick one")
+        e = self.graph[a][forward[0]]
+        backward = [i for i, r in enumerate(self.graph[b]) if r.to_id == a and r.line == e.line and r.minutes == e.minutes]
+        return forward[0], backward[0]
+
+    def add_edge(self, a: str, b: str, minutes: int, line: str, mode: str) -> List[str]:
+        """
+        Adds a two-way connection; returns the origins whose routes were recomputed.
+        """
+        for sid in (a, b):
+            if sid not in self.graph:
+                raise ValueError(f"Edge references unknown stations: {a} -> {b}")
+        self.graph[a].append(Edge(b, minutes, line, mode))
+        self.graph[b].append(Edge(a, minutes, line, mode))
+        return self._apply(a, b, set(), minutes)
+
+    def remove_edge(self, a: str, b: str, line: Optional[str] = None) -> List[str]:
+        """
+        Closes the connection between a and b (the one on line, if several).
+        """
+        i, j = self._find(a, b, line)
+        old_slots = self._slots_of(a, b, self.graph[a][i], self.graph[b][j])
+        del self.graph[a][i]
+        del self.graph[b][j]
+        return self._apply(a, b, old_slots, None)
+
+    def set_minutes(self, a: str, b: str, minutes: int, line: Optional[str] = None) -> List[str]:
+        """
+        Changes the travel time between a and b (the one on line, if several).
+        """
+        i, j = self._find(a, b, line)
+        e, r = self.graph[a][i], self.graph[b][j]
+        old_slots = self._slots_of(a, b, e, r)
+        self.graph[a][i] = Edge(e.to_id, minutes, e.line, e.mode)
+        self.graph[b][j] = Edge(r.to_id, minutes, r.line, r.mode)
+        return self._apply(a, b, old_slots, minutes)
+
+    def _slots_of(self, a: str, b: str, e: Edge, r: Edge) -> set:
+        cg = self.compiled
+        ia, ib = cg.index[a], cg.index[b]
+        slots = set()
+        for u, edge in ((ia, e), (ib, r)):
+            for slot in range(cg.offsets[u], cg.offsets[u + 1]):
+                if cg.edges[slot] is edge:
+                    slots.add(slot)
+        return slots
+
+    def _apply(self, a: str, b: str, old_slots: set, new_minutes: Optional[int]) -> List[str]:
+        old = self.compiled
+        ia, ib = old.index[a], old.index[b]
+
+        def shortcut(da: int, db: int) -> bool:
+            # Is the (new or faster) connection at least as good as the current route to an end?
+            if new_minutes is None:
+                return False
+            return (da != UNREACHED and da + new_minutes <= db) or (db != UNREACHED and db + new_minutes <= da)
+
+        def tree_stale(spt: ShortestPathTree) -> bool:
+            if spt.prev_slot[ia] in old_slots or spt.prev_slot[ib] in old_slots:
+                return True
+            return shortcut(spt.dist[ia], spt.dist[ib])
+
+        self.compiled = _remember_compiled(self.graph, compile_graph(self.graph))
+        self.version += 1
+        affected = {self.compiled.ids[o] for o in self.cache.repair(self.graph, self.compiled, tree_stale)}
+
+        zone_of = [self.stations[sid].zone for sid in self.compiled.ids]
+        n = len(old.ids)
+        for tm in self.matrices:
+            stale_rows = []
+            for o in range(n):
+                row = o * n
+                da, db = tm.minutes[row + ia], tm.minutes[row + ib]
+                da = UNREACHED if da < 0 else da
+                db = UNREACHED if db < 0 else db
+                uses_edge = bool(old_slots) and (tm.prev[row + ib] == ia or tm.prev[row + ia] == ib)
+                if uses_edge or shortcut(da, db):
+                    stale_rows.append(o)
+            rows = _matrix_rows(zone_of, self.zone_fares, self.bus_flat_fare, self.compiled, stale_rows)
+            for o, (minutes, prev, zones, required, fares) in zip(stale_rows, rows):
+                row = o * n
+                tm.minutes[row:row + n] = minutes
+                tm.prev[row:row + n] = prev
+                tm.zones[row:row + n] = zones
+                tm.required[row:row + n] = required
+                tm.fares[row:row + n] = fares
+                affected.add(self.compiled.ids[o])
+
+        return sorted(affected)
+
+
+#_______________________________________________________________________
+# Zone Fare logic   
+# ______________________________________________________________________
+"""
+Fares_zone = {
+    1: 2.50,
+    2: 3.75,
+    3: 4.90,
+}
+"""
+
+def zones_crossed(stations: Dict[str, Station], path: List[str]) -> int:
+    zones = [stations[sid].zone for sid in path]
+    return max(zones) - min(zones) + 1
+
+#_________________________________________________________________________
+# Helper: infer mode (simple)
+# ________________________________________________________________________
+
+def infer_mode_for_path(graph: Graph, path: List[str], edges: Optional[List[Edge]] = None) -> str:
+    """     
+    If ANY segment is TRAIN, treat the trip as TRAIN (zone-based).
+    Only return BUS if ALL the segments are BUS.
+    Pass the route's edges (from dijkstra_route) to skip the edge_info lookups.
+    """
+    if len(path) < 2:
+        return "TRAIN"
+
+    if edges is None:
+        edges = [edge_info(graph, a, b) for a, b in zip(path, path[1:])]
+    
+    saw_train = False
+    for e in edges:
+        if e.mode.upper() == "TRAIN":
+            saw_train = True
+
+    if saw_train == True:
+        return "TRAIN"
+    else:
+        return "BUS"        
+
+
+def compute_fare(zones: int, mode: str, zone_fares: Dict[int, float], bus_flat_fare: float) -> float:
+    mode = mode.upper()
+    if mode == "BUS":
+        return bus_flat_fare
+    return zone_fares.get(zones, zone_fares[max(zone_fares)])
+
+def build_edge_index(graph: Graph) -> Dict[Tuple[str, str], Edge]:
+    """
+    (a, b) -> Edge lookup table. When several lines connect a and b the fastest
+    one is kept (the first of equally fast ones), which is the edge Dijkstra relaxes.
+    """
+    index: Dict[Tuple[str, str], Edge] = {}
+    for a in graph:
+        for e in _edges_of(graph, a):
+            key = (a, e.to_id)
+            if key not in index or e.minutes < index[key].minutes:
+                index[key] = e
+    return index
+
+
+def edge_info(
+    graph: Graph,
+    a: str,
+    b: str,
+    index: Optional[Dict[Tuple[str, str], Edge]] = None
+) -> Edge: 
+    """
+    Find the edge used between two consecutive stations in the chosen path.
+    Assumes the graph contains an edge a -> b
+    With an index from build_edge_index this is a dict lookup instead of a scan.
+
+    """
+    if index is not None:
+        e = index.get((a, b))
+        if e is not None:
+            return e
+    else:
+        for e in _edges_of(graph, a): 
+            if e.to_id == b:
+                return e
+    raise ValueError(f"No edge found from {a} to {b} (path is inconsistent with graph). ")
+
+
+def segment_lines(graph: Graph, path: List[str], edges: Optional[List[Edge]] = None) -> List[str]:
+    """
+    Returns a list of line names for each segment in the route.
+    Example: path [A,B,C] -> lines ["Expo", "Expo"]
+    Pass the route's edges (from dijkstra_route) to skip the edge_info lookups.
+    """
+    if edges is not None:
+        return [e.line for e in edges]
+
+    lines = []
+    for a, b in zip(path, path[1:]):
+        e = edge_info(graph, a, b)
+        lines.append(e.line)
+    return lines
+
+def unique_lines_in_order(lines: List[str]) -> List[str]:
+    """   
+    Compress consecutive duplicates:
+    ["Expo","Expo", "Millenium","Millenium", "Expo"] -> ["Expo", "Millenium", "Expo"]
+
+    """
+    if not lines:
+        return []
+    out = [lines[0]]
+    for ln in lines[1:]:
+        if ln != out[-1]:
+            out.append(ln)
+    return out
+
+def transfer_stations(path: List[str], lines: List[str]) -> List[str]:
+    """   
+    Returns station IDs where a line change occurs.
+    If lines [i - 1] != lines[i], transfer happens at path[i]
+    """        
+
+    transfers = []
+    for i in range(1, len(lines)):
+        if lines[i] != lines[i - 1]:
+            transfers.append(path[i])
+    return transfers        
+
+def station_lines(graph: Graph) -> Dict[str, List[str]]:
+    lines_by_station: Dict[str, set] = {sid: set() for sid in graph}
+    for sid in lines_by_station:
+        for e in _edges_of(graph, sid): 
+            lines_by_station[sid].add(e.line)
+    return {sid: sorted(list(s)) for sid, s in lines_by_station.items()}        
+
+
+#____________________________________________________________________________________
+# Route summary (single pass)
+# ___________________________________________________________________________________
+
+@dataclass(slots = True)
+class RouteResult:
+    path: List[str]
+    edges: List[Edge]          # edges[i] goes path[i] -> path[i + 1]
+    minutes: int
+    lines: List[str]           # lines in travel order, consecutive duplicates removed
+    transfers: List[str]       # station IDs where the line changes
+    min_zone: int
+    max_zone: int
+    mode: str                  # "TRAIN" or "BUS", same rule as infer_mode_for_path
+    required_zones: int        # fare level, same rule as trip_required_zones
+
+    @property
+    def zones_crossed(self) -> int:
+        return self.max_zone - self.min_zone + 1
+
+
+def annotate_route(
+    stations: Dict[str, Station],
+    path: List[str],
+    edges: List[Edge],
+    minutes: int
+) -> RouteResult:
+    """
+    Walks the route once and collects what main() used to get from segment_lines,
+    unique_lines_in_order, transfer_stations, zones_crossed, infer_mode_for_path
+    and trip_required_zones (same results).
+    """
+    zone = stations[path[0]].zone
+    min_zone = max_zone = zone
+    lines: List[str] = []
+    transfers: List[str] = []
+    saw_train = not edges
+    last_line = None
+
+    for i, e in enumerate(edges):
+        if e.line != last_line:
+            if last_line is not None:
+                transfers.append(path[i])
+            lines.append(e.line)
+            last_line = e.line
+        if not saw_train and e.mode.upper() == "TRAIN":
+            saw_train = True
+        zone = stations[path[i + 1]].zone
+        if zone < min_zone:
+            min_zone = zone
+        elif zone > max_zone:
+            max_zone = zone
+
+    mode = "TRAIN" if saw_train else "BUS"
+    return RouteResult(
+        path = path,
+        edges = edges,
+        minutes = minutes,
+        lines = lines,
+        transfers = transfers,
+        min_zone = min_zone,
+        max_zone = max_zone,
+        mode = mode,
+        required_zones = trip_required_zones(mode, max_zone - min_zone + 1),
+    )
+
+
+def plan_route(
+    graph: Graph,
+    stations: Dict[str, Station],
+    start_id: str,
+    goal_id: str,
+    algorithm: str = "dijkstra"
+) -> Optional[RouteResult]:
+    route = dijkstra_route(graph, start_id, goal_id, algorithm)
+    if route is None:
+        return None
+    return annotate_route(stations, *route)
+
+
+#____________________________________________________________________________________
+# Multi-criteria routing (Pareto: time, transfers, fare)
+# ___________________________________________________________________________________
+
+@dataclass(slots = True)
+class ParetoOption:
+    route: RouteResult
+    transfers: int     # len(route.transfers)
+    fare: float        # charge from compute_fare_with_transfer_window
+
+
+def pareto_routes(
+    graph: Graph,
+    stations: Dict[str, Station],
+    start_id: str,
+    goal_id: str,
+    zone_fares: Dict[int, float],
+    window_minutes: int,
+    trip_time_minute: int = 0,
+    session: Optional[FareSession] = None,
+    max_transfers: int = 4,
+    max_extra_minutes: int = 30,
+    max_labels: int = 200_000,
+    fare_table: Optional["FareTable"] = None,
+    concession: int = 0,
+    product: int = 0
+) -> List[ParetoOption]:
+    """
+    All non-dominated routes over (travel minutes, transfers, fare), fastest first.
+    A label is one partial route: (minutes, transfers, lowest zone, highest zone,
+    used a TRAIN, current line). At a station a label is dropped when another one is
+    no worse on every count (a label on another line needs one transfer less to win,
+    since staying on its line may save one). Zone span and TRAIN only grow along a
+    route, so the fare charged so far is a lower bound (fares rise with zones).
+    Pruning keeps the search bounded: routes more than max_extra_minutes slower than
+    the fastest one, or with more than max_transfers, are never extended, and neither
+    are labels already beaten by a route found to the goal.
+    With fare_table, fares come from the table for the given concession / product.
+    A dict graph is compiled on the first query and reused after (see forget_compiled).
+    """
+    if start_id not in graph or goal_id not in graph:
+        return []
+
+    cg = _as_compiled(graph)
+    start, goal = cg.index[start_id], cg.index[goal_id]
+    offsets, targets, minutes_of, line_ids, mode_ids = cg.offsets, cg.targets, cg.minutes, cg.line_ids, cg.mode_ids
+    is_train = [m == "TRAIN" for m in cg.modes]
+    zone_of = [stations[sid].zone for sid in cg.ids]
+
+    # Exact minutes still needed from each station (the network is symmetric)
+    to_goal, _, _ = _csr_search(cg, goal)
+    if to_goal[start] == UNREACHED:
+        return []
+    time_limit = to_goal[start] + max_extra_minutes
+
+    charges: Dict[Tuple[int, int], float] = {}
+
+    def charge_for(lo: int, hi: int, train: int) -> float:
+        key = (hi - lo + 1, train)
+        if key not in charges:
+            mode = "TRAIN" if train else "BUS"
+            if fare_table is not None:
+                charges[key] = fare_table.rate(session, trip_time_minute, mode, key[0], concession, product)[0]
+            else:
+                charges[key] = compute_fare_with_transfer_window(
+                    session, trip_time_minute, trip_required_zones(mode, key[0]), zone_fares, window_minutes
+                )[0]
+        return charges[key]
+
+    # label = (minutes, transfers, lo, hi, train, line, station, parent label, slot)
+    z0 = zone_of[start]
+    labels = [(0, 0, z0, z0, 0, -1, start, -1, -1)]
+    alive = [True]
+    bags: Dict[int, List[int]] = {start: [0]}
+    pq = [(0, 0, 0)]
+    found: List[Tuple[int, int, float, int]] = []   # (minutes, transfers, fare, label)
+
+    def dominates(a: tuple, b: tuple) -> bool:
+        extra = 0 if (a[5] == b[5] or a[5] == -1) else 1
+        return (a[0] <= b[0] and a[1] + extra <= b[1]
+                and a[2] >= b[2] and a[3] <= b[3] and a[4] <= b[4])
+
+    while pq and len(labels) < max_labels:
+        _, _, li = heapq.heappop(pq)
+        if not alive[li]:
+            continue
+        m, t, lo, hi, train, line, u, _, _ = labels[li]
+
+        # The first train segment switches the trip to zone fares (TRAIN for the empty route too)
+        if u == goal:
+            fare = charge_for(lo, hi, train or line == -1)
+            if not any(fm <= m and ft <= t and ff <= fare for fm, ft, ff, _ in found):
+                found.append((m, t, fare, li))
+            continue
+
+        for slot in range(offsets[u], offsets[u + 1]):
+            v = targets[slot]
+            nm = m + minutes_of[slot]
+            if nm + to_goal[v] > time_limit:
+                continue
+            nline = line_ids[slot]
+            nt = t + (1 if (line != -1 and nline != line) else 0)
+            if nt > max_transfers:
+                continue
+            z = zone_of[v]
+            nlo = z if z < lo else lo
+            nhi = z if z > hi else hi
+            ntrain = 1 if (train or is_train[mode_ids[slot]]) else 0
+
+            # Target pruning: a route to the goal already beats anything this label can become
+            bound = charge_for(nlo, nhi, ntrain)
+            best_case = nm + to_goal[v]
+            if any(fm <= best_case and ft <= nt and ff <= bound for fm, ft, ff, _ in found):
+                continue
+
+            new = (nm, nt, nlo, nhi, ntrain, nline, v, li, slot)
+            bag = bags.setdefault(v, [])
+            if any(dominates(labels[o], new) for o in bag):
+                continue
+            keep = []
+            for o in bag:
+                if dominates(new, labels[o]):
+                    alive[o] = False
+                else:
+                    keep.append(o)
+            labels.append(new)
+            alive.append(True)
+            keep.append(len(labels) - 1)
+            bags[v] = keep
+            heapq.heappush(pq, (nm, nt, len(labels) - 1))
+
+    options: List[ParetoOption] = []
+    for m, t, fare, li in sorted(found):
+        if any(fm <= m and ft <= t and ff <= fare and (fm, ft, ff) != (m, t, fare)
+               for fm, ft, ff, _ in found):
+            continue
+        slots = []
+        cur = li
+        while labels[cur][7] != -1:
+            slots.append(labels[cur][8])
+            cur = labels[cur][7]
+        slots.reverse()
+        path = [start_id] + [cg.ids[targets[s]] for s in slots]
+        route = annotate_route(stations, path, [cg.edges[s] for s in slots], m)
+        options.append(ParetoOption(route, t, fare))
+    return options
+
+
+#____________________________________________________________________________________
+# K shortest loopless routes (Yen)
+# ___________________________________________________________________________________
+
+def _slot_path(cg: CompiledGraph, prev: List[int], prev_slot: List[int], goal: int) -> List[int]:
+    slots = []
+    cur = goal
+    while prev[cur] != -1:
+        slots.append(prev_slot[cur])
+        cur = prev[cur]
+    slots.reverse()
+    return slots
+
+
+def k_shortest_routes(
+    graph: Graph,
+    stations: Dict[str, Station],
+    start_id: str,
+    goal_id: str,
+    k: int = 3
+) -> List[RouteResult]:
+    """
+    Up to k loopless routes in order of travel time (Yen's algorithm). Each new route
+    branches off a previous one at a "spur" station: the stations before it are
+    blocked (keeps routes loopless) and so is the next edge of every accepted route
+    sharing that prefix, then one regular search finds the rest.
+    Routes are told apart by the edges they use, so two lines between the same
+    stations give two alternatives.
+    A dict graph is compiled on the first query and reused after (see forget_compiled).
+    """
+    if start_id not in graph or goal_id not in graph or k <= 0:
+        return []
+
+    cg = _as_compiled(graph)
+    start, goal = cg.index[start_id], cg.index[goal_id]
+    minutes, targets = cg.minutes, cg.targets
+
+    dist, prev, prev_slot = _csr_search(cg, start, goal)
+    if dist[goal] == UNREACHED:
+        return []
+
+    accepted: List[List[int]] = [_slot_path(cg, prev, prev_slot, goal)]
+    seen = {tuple(accepted[0])}
+    candidates: List[Tuple[int, int, Tuple[int, ...]]] = []
+
+    while len(accepted) < k:
+        last = accepted[-1]
+        nodes = [start] + [targets[slot] for slot in last]
+        root_cost = 0
+        for i in range(len(last)):
+            spur = nodes[i]
+            root = last[:i]
+            blocked_slots = {p[i] for p in accepted if len(p) > i and p[:i] == root}
+            spur_dist, spur_prev, spur_slot = _csr_search(
+                cg, spur, goal,
+                blocked_nodes = nodes[:i],
+                blocked_slots = blocked_slots,
+            )
+            if spur_dist[goal] != UNREACHED:
+                candidate = tuple(root + _slot_path(cg, spur_prev, spur_slot, goal))
+                if candidate not in seen:
+                    seen.add(candidate)
+                    heapq.heappush(candidates, (root_cost + spur_dist[goal], len(candidate), candidate))
+            root_cost += minutes[last[i]]
+
+        if not candidates:
+            break
+        _, _, best = heapq.heappop(candidates)
+        accepted.append(list(best))
+
+    routes = []
+    for slots in accepted:
+        path = [start_id] + [cg.ids[targets[slot]] for slot in slots]
+        routes.append(annotate_route(stations, path, [cg.edges[slot] for slot in slots], sum(minutes[slot] for slot in slots)))
+    return routes
+
+
+#____________________________________________________________________________________
+# Timetable + RAPTOR (round-based public transit routing)
+# ___________________________________________________________________________________
+"""
+data/timetable.json lists routes: one direction of one line with a fixed stop sequence.
+Trips along a route are given either explicitly,
+    "trips": [["06:00","06:02",...], ...]       (one time per stop)
+or as a repeating pattern,
+    "run_minutes": [0,2,4,...],                  (minutes after the first stop)
+    "departures": {"first":"05:30","last":"23:30","every":6}
+Times may run past midnight ("24:15") for late trips of the same service day.
+"""
+
+@dataclass
+class Timetable:
+    """
+    Array form of the timetable. Route r serves route_stops[route_stop_offsets[r]:...+n]
+    and has route_trip_counts[r] trips sorted by departure; the time of trip t at the
+    route's i-th stop is stop_times[route_time_offsets[r] + t * n + i] (n = stops on r).
+    Stop p is served by stop_routes[stop_route_offsets[p]:...], at position stop_route_pos[...].
+    """
+    ids: List[str]
+    index: Dict[str, int]
+    route_lines: List[str]
+    route_modes: List[str]
+    route_stop_offsets: array
+    route_stops: array
+    route_trip_counts: array
+    route_time_offsets: array
+    stop_times: array
+    stop_route_offsets: array
+    stop_routes: array
+    stop_route_pos: array
+
+
+def parse_service_minute(value: Union[int, str]) -> int:
+    """
+    Minutes after midnight of the service day. Accepts ints or "H:MM", with hours up
+    to 47 for trips that run after midnight.
+    """
+    if isinstance(value, int):
+        return value
+    parts = value.strip().split(":")
+    if len(parts) != 2:
+        raise ValueError(f"Time must be in Hours:minutes format: {value}")
+    hours, minutes = int(parts[0]), int(parts[1])
+    if not (0 <= hours <= 47 and 0 <= minutes <= 59):
+        raise ValueError(f"Invalid service time: {value}")
+    return hours * 60 + minutes
+
+
+def load_timetable(path: Path, stations: Dict[str, Station]) -> Timetable:
+    with path.open("r", encoding = "utf-8") as f:
+        rows = json.load(f)["routes"]
+
+    ids = sorted(stations)
+    index = {sid: i for i, sid in enumerate(ids)}
+    routes: List[Tuple[str, str, List[int], List[List[int]]]] = []
+
+    for row in rows:
+        stops = row["stops"]
+        for sid in stops:
+            if sid not in index:
+                raise ValueError(f"Timetable references unknown station: {sid} ({row['line']})")
+        if "trips" in row:
+            trips = [[parse_service_minute(t) for t in trip] for trip in row["trips"]]
+        else:
+            run = [int(m) for m in row["run_minutes"]]
+            dep = row["departures"]
+            first, last, every = parse_service_minute(dep["first"]), parse_service_minute(dep["last"]), int(dep["every"])
+            trips = [[start + m for m in run] for start in range(first, last + 1, every)]
+        for trip in trips:
+            if len(trip) != len(stops):
+                raise ValueError(f"Trip on {row['line']} has {len(trip)} times for {len(stops)} stops")
+            if any(a > b for a, b in zip(trip, trip[1:])):
+                raise ValueError(f"Trip on {row['line']} goes back in time: {trip}")
+        routes.append((row["line"], row.get("mode", "TRAIN").upper(), [index[s] for s in stops], trips))
+
+    return _build_timetable(ids, routes)
+
+
+def _split_overtaking(trips: List[List[int]]) -> List[List[List[int]]]:
+    """
+    Groups trips so that within a group no trip overtakes another (a later departure
+    is never earlier at any stop), which RAPTOR's earliest-trip binary search relies on.
+    Trips are placed first-fit in departure order, so FIFO routes stay one group.
+    """
+    groups: List[List[List[int]]] = []
+    for trip in sorted(trips):
+        for group in groups:
+            if all(a <= b for a, b in zip(group[-1], trip)):
+                group.append(trip)
+                break
+        else:
+            groups.append([trip])
+    return groups or [[]]
+
+
+def _build_timetable(ids: List[str], routes: List[Tuple[str, str, List[int], List[List[int]]]]) -> Timetable:
+    # routes: (line, mode, stop indexes, trips as one time per stop)
+    # A line direction whose trips overtake each other becomes several routes
+    routes = [(line, mode, stops, group) for line, mode, stops, trips in routes for group in _split_overtaking(trips)]
+    index = {sid: i for i, sid in enumerate(ids)}
+    route_stop_offsets, route_stops = array("l", [0]), array("l")
+    route_trip_counts, route_time_offsets, stop_times = array("l"), array("l"), array("l")
+    serving: List[List[Tuple[int, int]]] = [[] for _ in ids]
+
+    for r, (_, _, stops, trips) in enumerate(routes):
+        for pos, p in enumerate(stops):
+            serving[p].append((r, pos))
+        route_stops.extend(stops)
+        route_stop_offsets.append(len(route_stops))
+        route_trip_counts.append(len(trips))
+        route_time_offsets.append(len(stop_times))
+        for trip in trips:
+            stop_times.extend(trip)
+
+    stop_route_offsets, stop_routes, stop_route_pos = array("l", [0]), array("l"), array("l")
+    for p in range(len(ids)):
+        for r, pos in serving[p]:
+            stop_routes.append(r)
+            stop_route_pos.append(pos)
+        stop_route_offsets.append(len(stop_routes))
+
+    return Timetable(
+        ids = ids,
+        index = index,
+        route_lines = [line for line, _, _, _ in routes],
+        route_modes = [mode for _, mode, _, _ in routes],
+        route_stop_offsets = route_stop_offsets,
+        route_stops = route_stops,
+        route_trip_counts = route_trip_counts,
+        route_time_offsets = route_time_offsets,
+        stop_times = stop_times,
+        stop_route_offsets = stop_route_offsets,
+        stop_routes = stop_routes,
+        stop_route_pos = stop_route_pos,
+    )
+
+
+@dataclass(slots = True)
+class JourneyLeg:
+    line: str
+    mode: str
+    stops: List[str]       # boarding stop ... alighting stop
+    board_minute: int
+    alight_minute: int
+
+
+@dataclass(slots = True)
+class Journey:
+    departure_minute: int  # boarding time of the first leg
+    arrival_minute: int
+    legs: List[JourneyLeg]
+
+    @property
+    def transfers(self) -> int:
+        return max(0, len(self.legs) - 1)
+
+    @property
+    def path(self) -> List[str]:
+        if not self.legs:
+            return []
+        out = [self.legs[0].stops[0]]
+        for leg in self.legs:
+            out.extend(leg.stops[1:])
+        return out
+
+
+def _raptor_run(
+    tt: Timetable,
+    source: int,
+    target: int,
+    departure: int,
+    tau: List[List[int]],
+    best: List[int],
+    parent: List[List[Tuple[int, int, int, int]]],
+    min_transfer_minutes: int,
+    latest_source_boarding: int = UNREACHED
+) -> None:
+    """
+    One RAPTOR query. Round k scans every route through a stop improved in round k - 1
+    and records arrivals using exactly k trips in tau[k] (parent[k] says which
+    (route, trip, board position, alight position) got there). Arrays are updated in
+    place, so a range query can keep the labels of a later departure as upper bounds.
+    Trips leaving the source after latest_source_boarding are not boarded there.
+    """
+    stop_times = tt.stop_times
+    tau[0][source] = departure
+    if departure < best[source]:
+        best[source] = departure
+    marked = {source}
+
+    for k in range(1, len(tau)):
+        queue: Dict[int, int] = {}
+        for p in marked:
+            for j in range(tt.stop_route_offsets[p], tt.stop_route_offsets[p + 1]):
+                r, pos = tt.stop_routes[j], tt.stop_route_pos[j]
+                if pos < queue.get(r, UNREACHED):
+                    queue[r] = pos
+        marked = set()
+        before, now, came_from = tau[k - 1], tau[k], parent[k]
+
+        for r, first_pos in queue.items():
+            stop_base = tt.route_stop_offsets[r]
+            n_stops = tt.route_stop_offsets[r + 1] - stop_base
+            n_trips = tt.route_trip_counts[r]
+            time_base = tt.route_time_offsets[r]
+            trip, board = -1, -1
+
+            for i in range(first_pos, n_stops):
+                p = tt.route_stops[stop_base + i]
+                if trip != -1:
+                    arrival = stop_times[time_base + trip * n_stops + i]
+                    limit = best[p] if target == -1 or best[p] < best[target] else best[target]
+                    if arrival < limit:
+                        now[p] = arrival
+                        best[p] = arrival
+                        came_from[p] = (r, trip, board, i)
+                        marked.add(p)
+
+                ready = before[p]
+                if ready == UNREACHED:
+                    continue
+                if p != source:
+                    ready += min_transfer_minutes
+                # Earliest trip leaving p at or after ready (only worth it if earlier than the current one)
+                lo, hi = 0, n_trips if trip == -1 else trip
+                while lo < hi:
+                    mid = (lo + hi) // 2
+                    if stop_times[time_base + mid * n_stops + i] < ready:
+                        lo = mid + 1
+                    else:
+                        hi = mid
+                if lo < (n_trips if trip == -1 else trip):
+                    if p == source and stop_times[time_base + lo * n_stops + i] > latest_source_boarding:
+                        continue
+                    trip, board = lo, i
+
+        if not marked:
+            break
+
+
+def _raptor_journey(
+    tt: Timetable,
+    source: int,
+    target: int,
+    rounds: int,
+    parent: List[List[Tuple[int, int, int, int]]]
+) -> Journey:
+    legs: List[JourneyLeg] = []
+    p, k = target, rounds
+    while k > 0 and p != source:
+        r, trip, board, alight = parent[k][p]
+        stop_base = tt.route_stop_offsets[r]
+        n_stops = tt.route_stop_offsets[r + 1] - stop_base
+        time_base = tt.route_time_offsets[r] + trip * n_stops
+        legs.append(JourneyLeg(
+            line = tt.route_lines[r],
+            mode = tt.route_modes[r],
+            stops = [tt.ids[tt.route_stops[stop_base + i]] for i in range(board, alight + 1)],
+            board_minute = tt.stop_times[time_base + board],
+            alight_minute = tt.stop_times[time_base + alight],
+        ))
+        p = tt.route_stops[stop_base + board]
+        k -= 1
+    legs.reverse()
+    return Journey(legs[0].board_minute, legs[-1].alight_minute, legs)
+
+
+def _raptor_labels(tt: Timetable, max_transfers: int) -> Tuple[list, list, list]:
+    n, rounds = len(tt.ids), max_transfers + 2
+    tau = [[UNREACHED] * n for _ in range(rounds)]
+    parent = [[(-1, -1, -1, -1)] * n for _ in range(rounds)]
+    return tau, [UNREACHED] * n, parent
+
+
+def raptor_earliest_arrival(
+    tt: Timetable,
+    source_id: str,
+    target_id: str,
+    departure_minute: int,
+    max_transfers: int = 4,
+    min_transfer_minutes: int = 0
+) -> Optional[Journey]:
+    """
+    Earliest arrival at target_id leaving source_id at or after departure_minute,
+    using at most max_transfers + 1 trips. Among equally early journeys the one with
+    fewer transfers wins. Waiting for the next departure is included.
+    """
+    if source_id not in tt.index or target_id not in tt.index:
+        return None
+    source, target = tt.index[source_id], tt.index[target_id]
+    if source == target:
+        return Journey(departure_minute, departure_minute, [])
+
+    tau, best, parent = _raptor_labels(tt, max_transfers)
+    _raptor_run(tt, source, target, departure_minute, tau, best, parent, min_transfer_minutes)
+
+    arrivals = [tau[k][target] for k in range(1, len(tau))]
+    earliest = min(arrivals)
+    if earliest == UNREACHED:
+        return None
+    return _raptor_journey(tt, source, target, arrivals.index(earliest) + 1, parent)
+
+
+def raptor_range_query(
+    tt: Timetable,
+    source_id: str,
+    target_id: str,
+    earliest_departure: int,
+    latest_departure: int,
+    max_transfers: int = 4,
+    min_transfer_minutes: int = 0
+) -> List[Journey]:
+    """
+    Every useful journey leaving source_id between the two times (rRAPTOR): one run per
+    departure time at the source, latest first, reusing the labels of later runs.
+    A journey is kept unless another one leaves no earlier, arrives no later and has no
+    more transfers. Sorted by departure.
+    """
+    if source_id not in tt.index or target_id not in tt.index or source_id == target_id:
+        return []
+    source, target = tt.index[source_id], tt.index[target_id]
+
+    departures = set()
+    for j in range(tt.stop_route_offsets[source], tt.stop_route_offsets[source + 1]):
+        r, pos = tt.stop_routes[j], tt.stop_route_pos[j]
+        n_stops = tt.route_stop_offsets[r + 1] - tt.route_stop_offsets[r]
+        if pos == n_stops - 1:
+            continue
+        base = tt.route_time_offsets[r]
+        for t in range(tt.route_trip_counts[r]):
+            minute = tt.stop_times[base + t * n_stops + pos]
+            if earliest_departure <= minute <= latest_departure:
+                departures.add(minute)
+
+    tau, best, parent = _raptor_labels(tt, max_transfers)
+    found: List[Journey] = []
+    for departure in sorted(departures, reverse = True):
+        # A run may only board at the source inside the window, otherwise a journey leaving
+        # after latest_departure would become the label that in-window runs must beat
+        _raptor_run(tt, source, target, departure, tau, best, parent, min_transfer_minutes, latest_departure)
+        fewest_so_far = UNREACHED
+        for k in range(1, len(tau)):
+            arrival = tau[k][target]
+            if arrival >= fewest_so_far:
+                continue
+            fewest_so_far = arrival
+            journey = _raptor_journey(tt, source, target, k, parent)
+            if journey.departure_minute > latest_departure:
+                continue
+            if not any(
+                j.departure_minute >= journey.departure_minute
+                and j.arrival_minute <= journey.arrival_minute
+                and j.transfers <= journey.transfers
+                for j in found
+            ):
+                found.append(journey)
+
+    found.sort(key = lambda j: (j.departure_minute, j.transfers))
+    return found
+
+
+#____________________________________________________________________________________
+# Connection Scan (CSA)
+# ___________________________________________________________________________________
+
+def timetable_from_network(
+    graph: Graph,
+    headway_minutes: Union[int, Dict[str, int]] = 10,
+    first_departure: int = 5 * 60 + 30,
+    last_departure: int = 23 * 60 + 30
+) -> Timetable:
+    """
+    Synthesizes a timetable from the static network: the edges of each line are chained
+    into stop sequences (both directions), run times come from the edge minutes, and a
+    trip leaves the first stop every headway minutes (per line, or one value for all).
+    A line whose edges do not form simple chains is split into one route per edge.
+    """
+    cg = _as_compiled(graph)
+    routes: List[Tuple[str, str, List[int], List[List[int]]]] = []
+
+    # One (from, slot) per connection: skip the twin of a slot already taken
+    by_line: Dict[int, List[Tuple[int, int]]] = {}
+    for u in range(len(cg.ids)):
+        for slot in range(cg.offsets[u], cg.offsets[u + 1]):
+            twin = cg.rev[slot]
+            if twin == -1 or slot < twin:
+                by_line.setdefault(cg.line_ids[slot], []).append((u, slot))
+
+    for line_id, slots in by_line.items():
+        line = cg.lines[line_id]
+        mode = cg.modes[cg.mode_ids[slots[0][1]]]
+        every = headway_minutes if isinstance(headway_minutes, int) else headway_minutes.get(line, 10)
+
+        adj: Dict[int, List[Tuple[int, int]]] = {}
+        for u, slot in slots:
+            v = cg.targets[slot]
+            adj.setdefault(u, []).append((v, cg.minutes[slot]))
+            adj.setdefault(v, []).append((u, cg.minutes[slot]))
+
+        chains: List[Tuple[List[int], List[int]]] = []
+        if all(len(nbrs) <= 2 for nbrs in adj.values()):
+            seen = set()
+            ends = [u for u, nbrs in adj.items() if len(nbrs) == 1]
+            for u in ends + [u for u in adj if u not in ends]:
+                if u in seen:
+                    continue
+                stops, run = [u], [0]
+                seen.add(u)
+                cur = u
+                while True:
+                    nxt = [(v, m) for v, m in adj[cur] if v not in seen]
+                    if not nxt:
+                        # Close a loop line back to its first stop
+                        back = [m for v, m in adj[cur] if v == u and len(stops) > 2]
+                        if back:
+                            stops.append(u)
+                            run.append(run[-1] + back[0])
+                        break
+                    v, m = nxt[0]
+                    seen.add(v)
+                    stops.append(v)
+                    run.append(run[-1] + m)
+                    cur = v
+                if len(stops) > 1:
+                    chains.append((stops, run))
+        else:
+            for u, slot in slots:
+                chains.append(([u, cg.targets[slot]], [0, cg.minutes[slot]]))
+
+        for stops, run in chains:
+            back_run = [run[-1] - m for m in reversed(run)]
+            for seq, offsets in ((stops, run), (stops[::-1], back_run)):
+                trips = [[start + m for m in offsets] for start in range(first_departure, last_departure + 1, every)]
+                routes.append((line, mode, seq, trips))
+
+    return _build_timetable(list(cg.ids), routes)
+
+
+@dataclass
+class ConnectionTable:
+    """
+    Every elementary connection (one trip from one stop to the next), sorted by
+    departure time, as parallel arrays. trip_route / conn_pos locate a connection's
+    trip and its departure position on the Timetable route.
+    """
+    timetable: Timetable
+    dep_stop: array
+    arr_stop: array
+    dep_time: array
+    arr_time: array
+    trip: array
+    conn_pos: array
+    trip_route: array
+
+
+def build_connections(tt: Timetable) -> ConnectionTable:
+    rows = []
+    trip_route = array("l")
+    for r in range(len(tt.route_lines)):
+        stop_base = tt.route_stop_offsets[r]
+        n_stops = tt.route_stop_offsets[r + 1] - stop_base
+        for t in range(tt.route_trip_counts[r]):
+            trip_id = len(trip_route)
+            trip_route.append(r)
+            time_base = tt.route_time_offsets[r] + t * n_stops
+            for i in range(n_stops - 1):
+                rows.append((
+                    tt.stop_times[time_base + i], tt.stop_times[time_base + i + 1],
+                    tt.route_stops[stop_base + i], tt.route_stops[stop_base + i + 1],
+                    trip_id, i,
+                ))
+    rows.sort()
+
+    return ConnectionTable(
+        timetable = tt,
+        dep_stop = array("l", [row[2] for row in rows]),
+        arr_stop = array("l", [row[3] for row in rows]),
+        dep_time = array("l", [row[0] for row in rows]),
+        arr_time = array("l", [row[1] for row in rows]),
+        trip = array("l", [row[4] for row in rows]),
+        conn_pos = array("l", [row[5] for row in rows]),
+        trip_route = trip_route,
+    )
+
+
+def _csa_scan(
+    ct: ConnectionTable,
+    source: int,
+    departure: int,
+    target: int,
+    min_transfer_minutes: int
+) -> Tuple[List[int], List[int], List[int]]:
+    """
+    One linear pass over the connections departing at or after departure.
+    Returns (arrival per stop, entry connection per stop, exit connection per stop):
+    the last leg into a stop boarded its trip at the entry and left it at the exit.
+    Stops scanning once departures are later than the best arrival at target.
+    """
+    n = len(ct.timetable.ids)
+    arrival = [UNREACHED] * n
+    entry = [-1] * n
+    exit_ = [-1] * n
+    boarded = {}   # trip -> connection where it was boarded
+    arrival[source] = departure
+
+    dep_stop, arr_stop, dep_time, arr_time, trips = ct.dep_stop, ct.arr_stop, ct.dep_time, ct.arr_time, ct.trip
+    c = bisect.bisect_left(dep_time, departure)
+    for c in range(c, len(dep_time)):
+        if target != -1 and dep_time[c] >= arrival[target]:
+            break
+        trip = trips[c]
+        if trip not in boarded:
+            p = dep_stop[c]
+            ready = arrival[p]
+            if ready == UNREACHED:
+                continue
+            if p != source:
+                ready += min_transfer_minutes
+            if ready > dep_time[c]:
+                continue
+            boarded[trip] = c
+        elif dep_stop[c] == source:
+            # The trip comes back past the origin: boarding it here is the same arrival,
+            # leaving later, instead of a round trip out and back
+            boarded[trip] = c
+        q = arr_stop[c]
+        if arr_time[c] < arrival[q]:
+            arrival[q] = arr_time[c]
+            entry[q] = boarded[trip]
+            exit_[q] = c
+
+    return arrival, entry, exit_
+
+
+def _csa_journey(ct: ConnectionTable, source: int, target: int, entry: List[int], exit_: List[int]) -> Journey:
+    tt = ct.timetable
+    legs: List[JourneyLeg] = []
+    p = target
+    while p != source:
+        first, last = entry[p], exit_[p]
+        r = ct.trip_route[ct.trip[first]]
+        stop_base = tt.route_stop_offsets[r]
+        stops = [tt.ids[tt.route_stops[stop_base + i]] for i in range(ct.conn_pos[first], ct.conn_pos[last] + 2)]
+        legs.append(JourneyLeg(tt.route_lines[r], tt.route_modes[r], stops, ct.dep_time[first], ct.arr_time[last]))
+        p = ct.dep_stop[first]
+    legs.reverse()
+    return Journey(legs[0].board_minute, legs[-1].alight_minute, legs)
 
-    if saw_train == True:
-        return "TRAIN"
-    else:
-        return "BUS"        
 
+def csa_earliest_arrival(
+    ct: ConnectionTable,
+    source_id: str,
+    target_id: str,
+    departure_minute: int,
+    min_transfer_minutes: int = 0
+) -> Optional[Journey]:
+    tt = ct.timetable
+    if source_id not in tt.index or target_id not in tt.index:
+        return None
+    source, target = tt.index[source_id], tt.index[target_id]
+    if source == target:
+        return Journey(departure_minute, departure_minute, [])
+    arrival, entry, exit_ = _csa_scan(ct, source, departure_minute, target, min_transfer_minutes)
+    if arrival[target] == UNREACHED:
+        return None
+    return _csa_journey(ct, source, target, entry, exit_)
 
-def compute_fare(zones: int, mode: str, zone_fares: Dict[int, float], bus_flat_fare: float) -> float:
-    mode = mode.upper()
-    if mode == "BUS":
-        return bus_flat_fare
-    return zone_fares.get(zones, zone_fares[max(zone_fares)])
 
-def edge_info(graph: Dict[str, List[Edge]], a: str, b: str) -> Edge: 
+def csa_one_to_all(
+    ct: ConnectionTable,
+    source_id: str,
+    departure_minute: int,
+    min_transfer_minutes: int = 0
+) -> Dict[str, int]:
     """
-    Find the edge used between two consecutive stations in the chosen path.
-    Assumes the graph contains an edge a -> b
-
+    Earliest arrival minute at every reachable stop.
     """
-    for e in graph[a]: 
-        if e.to_id == b:
-            return e
-    raise ValueError(f"No edge found from {a} to {b} (path is inconsistent with graph). ")
+    tt = ct.timetable
+    arrival, _, _ = _csa_scan(ct, tt.index[source_id], departure_minute, -1, min_transfer_minutes)
+    return {tt.ids[p]: a for p, a in enumerate(arrival) if a != UNREACHED}
 
 
-def segment_lines(graph: Dict[str, List[Edge]], path: List[str]) -> List[str]:
+def csa_profile(
+    ct: ConnectionTable,
+    source_id: str,
+    target_id: str,
+    earliest_departure: int,
+    latest_departure: int,
+    min_transfer_minutes: int = 0
+) -> List[Journey]:
     """
-    Returns a list of line names for each segment in the route.
-    Example: path [A,B,C] -> lines ["Expo", "Expo"]
+    "Leave between 8:00 and 9:00": every journey from source to target departing in the
+    window that is not beaten by a later departure arriving no later.
+    One backwards scan builds each stop's (departure, arrival at target) profile, then
+    every profile entry at the source is expanded into its Journey.
     """
-    lines = []
-    for a, b in zip(path, path[1:]):
-        e = edge_info(graph, a, b)
-        lines.append(e.line)
-    return lines
+    tt = ct.timetable
+    if source_id not in tt.index or target_id not in tt.index or source_id == target_id:
+        return []
+    source, target = tt.index[source_id], tt.index[target_id]
 
-def unique_lines_in_order(lines: List[str]) -> List[str]:
-    """   
-    Compress consecutive duplicates:
-    ["Expo","Expo", "Millenium","Millenium", "Expo"] -> ["Expo", "Millenium", "Expo"]
+    # profile[p]: (departure, arrival, connection boarded) entries, departures falling,
+    # arrivals falling too. For every useful connection c, exit_of[c] is where its rider
+    # gets off the trip and then_board[c] the connection boarded next (-1 = at target).
+    profile: List[List[Tuple[int, int, int]]] = [[] for _ in tt.ids]
+    on_trip: Dict[int, Tuple[int, int]] = {}   # trip -> (best arrival staying on, connection)
+    exit_of: Dict[int, int] = {}
+    then_board: Dict[int, int] = {}
+    dep_stop, arr_stop, dep_time, arr_time, trips = ct.dep_stop, ct.arr_stop, ct.dep_time, ct.arr_time, ct.trip
+    first = bisect.bisect_left(dep_time, earliest_departure)
+
+    for c in range(len(dep_time) - 1, first - 1, -1):
+        q = arr_stop[c]
+        trip = trips[c]
+        best, exit_c, next_c = UNREACHED, -1, -1
+        if q == target:
+            best, exit_c = arr_time[c], c
+        stay, later = on_trip.get(trip, (UNREACHED, -1))
+        if stay < best:
+            best, exit_c, next_c = stay, exit_of[later], then_board[later]
+        # Change at q: earliest profile entry leaving late enough (entries are few, scan from the back)
+        ready = arr_time[c] + min_transfer_minutes
+        for dep, arr, board in reversed(profile[q]):
+            if dep >= ready:
+                if arr < best:
+                    best, exit_c, next_c = arr, c, board
+                break
+        if best == UNREACHED:
+            continue
+        exit_of[c] = exit_c
+        then_board[c] = next_c
+        if best < stay:
+            on_trip[trip] = (best, c)
+        # Departures from the source after the window must not shadow ones inside it
+        if dep_stop[c] == source and dep_time[c] > latest_departure:
+            continue
+        entries = profile[dep_stop[c]]
+        if not entries or best < entries[-1][1]:
+            if entries and entries[-1][0] == dep_time[c]:
+                entries[-1] = (dep_time[c], best, c)
+            else:
+                entries.append((dep_time[c], best, c))
 
+    journeys: List[Journey] = []
+    for _, _, board in reversed(profile[source]):
+        legs: List[JourneyLeg] = []
+        while board != -1:
+            last = exit_of[board]
+            r = ct.trip_route[trips[board]]
+            stop_base = tt.route_stop_offsets[r]
+            stops = [tt.ids[tt.route_stops[stop_base + i]] for i in range(ct.conn_pos[board], ct.conn_pos[last] + 2)]
+            legs.append(JourneyLeg(tt.route_lines[r], tt.route_modes[r], stops, dep_time[board], arr_time[last]))
+            board = then_board[board]
+        journeys.append(Journey(legs[0].board_minute, legs[-1].alight_minute, legs))
+    return journeys
+
+
+def journey_required_zones(journey: Journey, stations: Dict[str, Station]) -> int:
     """
-    if not lines:
-        return []
-    out = [lines[0]]
-    for ln in lines[1:]:
-        if ln != out[-1]:
-            out.append(ln)
-    return out
+    Same fare rules as a static route: bus-only journeys are 1 zone, otherwise the zone span.
+    """
+    return trip_required_zones(*_journey_mode_zones(journey, stations))
 
-def transfer_stations(path: List[str], lines: List[str]) -> List[str]:
-    """   
-    Returns station IDs where a line change occurs.
-    If lines [i - 1] != lines[i], transfer happens at path[i]
-    """        
 
-    transfers = []
-    for i in range(1, len(lines)):
-        if lines[i] != lines[i - 1]:
-            transfers.append(path[i])
-    return transfers        
+def _journey_mode_zones(journey: Journey, stations: Dict[str, Station]) -> Tuple[str, int]:
+    path = journey.path
+    if not path:
+        return "BUS", 1
+    zones = [stations[sid].zone for sid in path]
+    mode = "TRAIN" if any(leg.mode.upper() == "TRAIN" for leg in journey.legs) else "BUS"
+    return mode, max(zones) - min(zones) + 1
 
-def station_lines(graph: Dict[str, List[Edge]]) -> Dict[str, List[str]]:
-    lines_by_station: Dict[str, set] = {sid: set() for sid in graph}
-    for sid, edges in graph.items():
-        for e in edges: 
-            lines_by_station[sid].add(e.line)
-    return {sid: sorted(list(s)) for sid, s in lines_by_station.items()}        
+
+def journey_fare(
+    journey: Journey,
+    stations: Dict[str, Station],
+    zone_fares: Dict[int, float],
+    window_minutes: int,
+    session: Optional[FareSession] = None,
+    fare_table: Optional["FareTable"] = None,
+    concession: int = 0,
+    product: int = 0
+) -> Tuple[float, FareSession]:
+    """
+    compute_fare_with_transfer_window for a timetable journey, using the minute the
+    rider actually boards (not the minute they asked for) as the trip time.
+    With fare_table the table prices it instead (zone_fares / window_minutes unused).
+    """
+    if fare_table is not None:
+        mode, zones = _journey_mode_zones(journey, stations)
+        return fare_table.rate(session, journey.departure_minute, mode, zones, concession, product)
+    return compute_fare_with_transfer_window(
+        session = session,
+        trip_time_minute = journey.departure_minute,
+        required_zones = journey_required_zones(journey, stations),
+        zone_fares = zone_fares,
+        window_minutes = window_minutes,
+    )
 
 
 #____________________________________________________________________________________
@@ -267,6 +3435,21 @@ def parse_hhmm_to_minute(s: str) -> int:
         raise ValueError("Invalid time. Use 00:00 to 23:59.")
     return hours * 60 + minutes
 
+def get_fare_choice(prompt: str, names: List[str]) -> int:
+    """
+    Index of the concession / product the rider picks; no question when there's only one.
+    """
+    if len(names) == 1:
+        return 0
+    while True:
+        s = input(f"{prompt} ({'/'.join(names)}) [{names[0]}]: ").strip().lower()
+        if not s:
+            return 0
+        lowered = [n.lower() for n in names]
+        if s in lowered:
+            return lowered.index(s)
+        print("Invalid choice. Please try again.")
+
 def get_time_minute(prompt: str) -> int:
     while True:
         try:
@@ -327,17 +3510,930 @@ def compute_fare_with_transfer_window(
 
 
 
+#_____________________________________________________________________________
+# Fare rules (declarative, compiled to a lookup table)
+# ____________________________________________________________________________
+"""
+fares.json can describe the fare policy as data instead of code:
+    "fare_rules": {
+        "concessions": ["adult", "concession"],           (first = default)
+        "products": {"stored_value": 90, "paper": 60},     (transfer window minutes, first = default)
+        "rules": [
+            {"zones": 1, "price": 2.50},
+            {"zones": [2, 3], "price": 3.75},
+            {"mode": "BUS", "charge_zones": 1},
+            {"band": ["early", "evening"], "zones": [2, 3], "charge_zones": 1},
+            {"concession": "concession", "multiply": 0.8}
+        ]
+    }
+Rules are applied in order and a later rule overrides an earlier one wherever both match.
+A rule matches on any of concession / band (names from time_bands) / mode / zones (a number
+or an inclusive [lo, hi]; omitted = everything) and then either
+    charge_zones: fare level for trips crossing those zones (default: zones crossed), or
+    price / multiply: price of those fare levels ("zones" is the fare level here; mode is not allowed).
+Without fare_rules the table is built from zone_fares and the BUS = 1 zone rule.
+"""
+
+@dataclass
+class FareTable:
+    """
+    Compiled fare rules. A trip's fare level and price are single array reads:
+    levels[((concession * bands + band) * modes + mode) * (max_zones + 1) + zones]
+    prices[(concession * bands + band) * (max_zones + 1) + level]
+    Mode 0 stands for any mode the rules don't name; zones above max_zones count as max_zones.
+    """
+    concessions: List[str]
+    products: List[str]
+    windows: array          # 'l', transfer window minutes per product
+    bands: List[str]
+    band_of_minute: array   # 'B'
+    modes: List[str]
+    max_zones: int
+    levels: array           # 'l'
+    prices: array           # 'd'
+
+    def concession_id(self, name: str) -> int:
+        return self.concessions.index(name)
+
+    def product_id(self, name: str) -> int:
+        return self.products.index(name)
+
+    def mode_id(self, mode: str) -> int:
+        mode = mode.upper()
+        return self.modes.index(mode) if mode in self.modes else 0
+
+    def required_zones(self, mode: str, zones: int, minute: int = 0, concession: int = 0) -> int:
+        z = zones if zones < self.max_zones else self.max_zones
+        row = concession * len(self.bands) + self.band_of_minute[minute % 1440]
+        return self.levels[(row * len(self.modes) + self.mode_id(mode)) * (self.max_zones + 1) + z]
+
+    def level_price(self, level: int, minute: int = 0, concession: int = 0) -> float:
+        level = level if level < self.max_zones else self.max_zones
+        row = concession * len(self.bands) + self.band_of_minute[minute % 1440]
+        return self.prices[row * (self.max_zones + 1) + level]
+
+    def trip_fare(self, mode: str, zones: int, minute: int = 0, concession: int = 0) -> float:
+        return self.level_price(self.required_zones(mode, zones, minute, concession), minute, concession)
+
+    def rate(
+        self,
+        session: Optional[FareSession],
+        trip_time_minute: int,
+        mode: str,
+        zones: int,
+        concession: int = 0,
+        product: int = 0
+    ) -> Tuple[float, FareSession]:
+        """
+        compute_fare_with_transfer_window with the table's prices and the product's window.
+        Already-paid levels are credited at the current tap's price for that level.
+        """
+        required = self.required_zones(mode, zones, trip_time_minute, concession)
+        return self.rate_level(session, trip_time_minute, required, concession, product)
+
+    def rate_level(
+        self,
+        session: Optional[FareSession],
+        trip_time_minute: int,
+        required: int,
+        concession: int = 0,
+        product: int = 0
+    ) -> Tuple[float, FareSession]:
+        """
+        rate() for a trip whose fare level is already known (e.g. the required_zones of a tap).
+        """
+        trip_cost = self.level_price(required, trip_time_minute, concession)
+
+        if session is None or (trip_time_minute - session.start_minute) > self.windows[product]:
+            return trip_cost, FareSession(start_minute = trip_time_minute, paid_zones = required)
+
+        if required <= session.paid_zones:
+            return 0.0, session
+
+        already_paid_cost = self.level_price(session.paid_zones, trip_time_minute, concession)
+        return max(0.0, trip_cost - already_paid_cost), FareSession(
+            start_minute = session.start_minute,
+            paid_zones = required
+        )
+
+
+    def flat_fares(self) -> Tuple[Dict[int, float], float, int]:
+        """
+        (zone_fares, bus_flat_fare, transfer_window_minutes) for the default concession,
+        band and product: what load_network returns for code that prices routes statically.
+        """
+        width = self.max_zones + 1
+        zone_fares = {z: self.prices[z] for z in range(1, width)}
+        bus_level = self.levels[self.mode_id("BUS") * width + 1]
+        return zone_fares, self.prices[bus_level], self.windows[0]
+
+
+_RULE_KEYS = {"concession", "band", "mode", "zones", "charge_zones", "price", "multiply"}
+
+def compile_fare_rules(
+    fare_rules: dict,
+    time_bands: Optional[Dict[str, List[str]]] = None
+) -> FareTable:
+    """
+    Turns a fare_rules block (see above) into a FareTable. Raises ValueError for unknown
+    keys or names, and when some fare level is left without a price.
+    """
+    concessions = list(fare_rules.get("concessions", ["adult"]))
+    products_block = fare_rules.get("products", {"default": 60})
+    products = list(products_block)
+    windows = array("l", [int(products_block[p]) for p in products])
+    bands, band_of_minute = _band_of_minute(time_bands or {})
+    rules = fare_rules.get("rules", [])
+
+    def zone_range(rule: dict) -> Tuple[int, int]:
+        z = rule.get("zones")
+        if z is None:
+            return 1, max_zones
+        if isinstance(z, int):
+            return z, z
+        if len(z) != 2 or not 1 <= int(z[0]) <= int(z[1]):
+            raise ValueError(f"Fare rule {rule}: zones must be a number or [lo, hi]")
+        return int(z[0]), int(z[1])
+
+    def wanted(rule: dict, key: str) -> List[str]:
+        value = rule.get(key, [])
+        values = [value] if isinstance(value, str) else list(value)
+        return [v.upper() for v in values] if key == "mode" else values
+
+    def pick(rule: dict, key: str, names: List[str]) -> List[int]:
+        if key not in rule:
+            return list(range(len(names)))
+        for name in wanted(rule, key):
+            if name not in names:
+                raise ValueError(f"Fare rule {rule}: unknown {key} {name!r}")
+        return [names.index(name) for name in wanted(rule, key)]
+
+    modes = ["*"]
+    max_zones = 1
+    for rule in rules:
+        unknown = set(rule) - _RULE_KEYS
+        if unknown:
+            raise ValueError(f"Fare rule {rule}: unknown keys {sorted(unknown)}")
+        if "charge_zones" in rule and ("price" in rule or "multiply" in rule):
+            raise ValueError(f"Fare rule {rule}: set either charge_zones or a price, not both")
+        if ("price" in rule or "multiply" in rule) and "mode" in rule:
+            raise ValueError(f"Fare rule {rule}: prices are per fare level, not per mode")
+        for mode in wanted(rule, "mode"):
+            if mode not in modes:
+                modes.append(mode)
+        if rule.get("zones") is not None:
+            max_zones = max(max_zones, zone_range(rule)[1])
+        max_zones = max(max_zones, int(rule.get("charge_zones", 1)))
+
+    width = max_zones + 1
+    rows = len(concessions) * len(bands)
+    levels = array("l", list(range(width)) * (rows * len(modes)))
+    prices = array("d", [float("nan")]) * (rows * width)
+
+    for rule in rules:
+        lo, hi = zone_range(rule)
+        cells = [
+            c * len(bands) + b
+            for c in pick(rule, "concession", concessions)
+            for b in pick(rule, "band", bands)
+        ]
+        if "charge_zones" in rule:
+            for row in cells:
+                for m in pick(rule, "mode", modes):
+                    base = (row * len(modes) + m) * width
+                    for z in range(lo, hi + 1):
+                        levels[base + z] = int(rule["charge_zones"])
+        else:
+            for row in cells:
+                for z in range(lo, hi + 1):
+                    if "price" in rule:
+                        prices[row * width + z] = float(rule["price"])
+                    else:
+                        prices[row * width + z] *= float(rule["multiply"])
+
+    for row in range(rows):
+        for z in range(1, width):
+            if prices[row * width + z] != prices[row * width + z]:   # NaN: never priced
+                c, b = divmod(row, len(bands))
+                raise ValueError(f"No price for {z} zone(s), concession {concessions[c]!r}, band {bands[b]!r}")
+        prices[row * width] = 0.0
+
+    return FareTable(concessions, products, windows, bands, band_of_minute, modes, max_zones, levels, prices)
+
+
+def legacy_fare_rules(zone_fares: Dict[int, float], window_minutes: int) -> dict:
+    """
+    The fare_rules block equivalent to zone_fares + trip_required_zones +
+    compute_fare_with_transfer_window (BUS trips are charged as 1 zone).
+    """
+    top = max(zone_fares)
+    rules: List[dict] = [{"price": fare_for_zones(z, zone_fares), "zones": z} for z in range(1, top + 1)]
+    rules.append({"mode": "BUS", "charge_zones": 1})
+    return {"products": {"default": window_minutes}, "rules": rules}
+
+
+def _fare_table_from_json(fares: dict) -> FareTable:
+    if "fare_rules" in fares:
+        block = fares["fare_rules"]
+    else:
+        zone_fares = {int(k): float(v) for k, v in fares["zone_fares"].items()}
+        block = legacy_fare_rules(zone_fares, int(fares.get("transfer_window_minutes", 60)))
+    return compile_fare_rules(block, fares.get("time_bands", {}))
+
+
+def _flat_fares_from_json(fares: dict) -> Tuple[Dict[int, float], float, int]:
+    """
+    zone_fares / bus_flat_fare / transfer_window_minutes from fares.json. With fare_rules
+    they come from the compiled table, so there is one price source; the old keys may
+    still be present, but only if they agree with the rules.
+    """
+    if "fare_rules" not in fares:
+        return (
+            {int(k): float(v) for k, v in fares["zone_fares"].items()},
+            float(fares["bus_flat_fare"]),
+            int(fares.get("transfer_window_minutes", 60)),
+        )
+
+    zone_fares, bus_flat, window = _fare_table_from_json(fares).flat_fares()
+    if "zone_fares" in fares and {int(k): float(v) for k, v in fares["zone_fares"].items()} != zone_fares:
+        raise ValueError("fares.json: zone_fares disagrees with fare_rules; drop one of them")
+    if "bus_flat_fare" in fares and float(fares["bus_flat_fare"]) != bus_flat:
+        raise ValueError("fares.json: bus_flat_fare disagrees with fare_rules; drop one of them")
+    if "transfer_window_minutes" in fares and int(fares["transfer_window_minutes"]) != window:
+        raise ValueError("fares.json: transfer_window_minutes disagrees with the first fare_rules product")
+    return zone_fares, bus_flat, window
+
+
+def load_fare_table(data_dir: Path) -> FareTable:
+    """
+    The FareTable every charge is computed with: fare_rules if fares.json has them,
+    otherwise the legacy zone_fares compiled by legacy_fare_rules.
+    """
+    with (data_dir / "fares.json").open("r", encoding = "utf-8") as f:
+        return _fare_table_from_json(json.load(f))
+
+
+#_____________________________________________________________________________
+# Daily / weekly fare caps
+# ____________________________________________________________________________
+
+@dataclass(frozen = True)
+class FareCaps:
+    """
+    Most a card pays per service day / service week (None = no cap). A service day
+    runs from service_day_start to the same time next day, so a 00:30 tap still counts
+    towards the day before. Tap minutes are counted from midnight at the start of the
+    first day of a week (minute 1440 = 00:00 on day 2, and so on).
+    """
+    daily: Optional[float] = None
+    weekly: Optional[float] = None
+    service_day_start: int = 240     # 04:00
+
+    def service_day(self, minute: int) -> int:
+        return (minute - self.service_day_start) // 1440
+
+
+@dataclass(slots = True)
+class CapState:
+    day: int
+    day_spent: float
+    week: int
+    week_spent: float
+
+
+def load_fare_caps(data_dir: Path) -> FareCaps:
+    """
+    Reads the optional fare_caps block of fares.json:
+    {"daily": 11.25, "weekly": 56.00, "service_day_start": "04:00"}
+    Without it nothing is capped.
+    """
+    with (data_dir / "fares.json").open("r", encoding = "utf-8") as f:
+        block = json.load(f).get("fare_caps", {})
+    start = block.get("service_day_start", "04:00")
+    return FareCaps(
+        daily = float(block["daily"]) if block.get("daily") is not None else None,
+        weekly = float(block["weekly"]) if block.get("weekly") is not None else None,
+        service_day_start = parse_hhmm_to_minute(start),
+    )
+
+
+def _cap_room(caps: FareCaps, day_spent: float, week_spent: float) -> float:
+    # What the card can still be charged before hitting a cap (rounded to cents)
+    room = float("inf")
+    if caps.daily is not None:
+        room = min(room, round(caps.daily - day_spent, 2))
+    if caps.weekly is not None:
+        room = min(room, round(caps.weekly - week_spent, 2))
+    return max(0.0, room)
+
+
+def apply_fare_cap(
+    caps: FareCaps,
+    state: Optional[CapState],
+    trip_time_minute: int,
+    charge: float
+) -> Tuple[float, CapState]:
+    """
+    Returns: (capped_charge, updated_state)
+    Runs after compute_fare_with_transfer_window on its charge: the day / week totals
+    restart when the tap falls in a new service day / week, then the charge is cut down
+    to whatever is left under the caps. state is updated in place.
+    """
+    day = caps.service_day(trip_time_minute)
+    week = day // 7
+    if state is None:
+        state = CapState(day, 0.0, week, 0.0)
+    if day != state.day:
+        state.day, state.day_spent = day, 0.0
+    if week != state.week:
+        state.week, state.week_spent = week, 0.0
+    capped = min(charge, _cap_room(caps, state.day_spent, state.week_spent))
+    state.day_spent += capped
+    state.week_spent += capped
+    return capped, state
+
+
+#_____________________________________________________________________________
+# Batch fare rating (tap logs)
+# ____________________________________________________________________________
+
+@dataclass(slots = True)
+class TapCharges:
+    """
+    Per-tap output of rate_taps, in the order the taps were given. session_start and
+    paid_zones are the card's FareSession right after that tap.
+    """
+    charges: array        # 'd'
+    session_start: array  # 'q'
+    paid_zones: array     # 'l'
+    sessions: Dict[int, FareSession]   # last session of every card
+    cap_states: Dict[int, CapState]    # day / week totals of every card (with caps)
+
+
+def rate_taps(
+    cards: Sequence[int],
+    minutes: Sequence[int],
+    required_zones: Sequence[int],
+    zone_fares: Dict[int, float],
+    window_minutes: int,
+    sessions: Optional[Dict[int, FareSession]] = None,
+    caps: Optional[FareCaps] = None,
+    cap_states: Optional[Dict[int, CapState]] = None,
+    fare_table: Optional[FareTable] = None,
+    concessions: Optional[Sequence[int]] = None,
+    products: Optional[Sequence[int]] = None
+) -> TapCharges:
+    """
+    compute_fare_with_transfer_window over a whole tap log given as columns (array('q')
+    or lists). Taps are put in card, then time order (taps of one card in the same minute
+    keep their input order), and each card's session is carried through plain ints
+    instead of a FareSession per tap. Charges are exactly what the scalar function gives
+    when the taps are fed to it in that order. sessions: open sessions to start from,
+    e.g. the .sessions of the previous day's run. With caps, every charge then goes
+    through apply_fare_cap (cap_states carries the running totals between runs).
+    With fare_table, prices and transfer windows come from the table (FareTable.rate_level)
+    instead of zone_fares / window_minutes; concessions and products are optional
+    columns of table ids (default: the table's first concession / product).
+    """
+    n = len(cards)
+    for column in (minutes, required_zones, concessions, products):
+        if column is not None and len(column) != n:
+            raise ValueError("cards, minutes, required_zones (and concessions / products) must have the same length")
+
+    # Two stable sorts = sort by (card, minute), ties in input order
+    order = sorted(range(n), key = minutes.__getitem__)
+    order.sort(key = cards.__getitem__)
+
+    if fare_table is not None:
+        price = fare_table.level_price
+        windows = fare_table.windows
+    else:
+        fare_of: Dict[int, float] = {}
+
+        def price(level: int, minute: int, concession: int) -> float:
+            fare = fare_of.get(level)
+            if fare is None:
+                fare = fare_of[level] = fare_for_zones(level, zone_fares)
+            return fare
+
+    charges = array("d", [0.0]) * n
+    session_start = array("q", [0]) * n
+    paid_zones = array("l", [0]) * n
+    opened = dict(sessions) if sessions else {}
+    totals = dict(cap_states) if cap_states else {}
+
+    card = None
+    start = paid = 0
+    active = False
+    totals_of_card: Optional[CapState] = None
+    for i in order:
+        c = cards[i]
+        if c != card:
+            if active:
+                opened[card] = FareSession(start, paid)
+            if totals_of_card is not None:
+                totals[card] = totals_of_card
+            # apply_fare_cap updates in place: work on a copy so cap_states (and any
+            # earlier result they came from) stay as they were
+            prior_totals = totals.get(c)
+            totals_of_card = None if prior_totals is None else CapState(
+                prior_totals.day, prior_totals.day_spent, prior_totals.week, prior_totals.week_spent
+            )
+            card = c
+            prior = opened.get(c)
+            active = prior is not None
+            if active:
+                start, paid = prior.start_minute, prior.paid_zones
+        t = minutes[i]
+        z = required_zones[i]
+        conc = concessions[i] if concessions is not None else 0
+        if fare_table is None:
+            window = window_minutes
+        else:
+            window = windows[products[i] if products is not None else 0]
+        if not active or t - start > window:
+            charges[i] = price(z, t, conc)
+            start, paid = t, z
+            active = True
+        elif z > paid:
+            charges[i] = max(0.0, price(z, t, conc) - price(paid, t, conc))
+            paid = z
+        if caps is not None:
+            charges[i], totals_of_card = apply_fare_cap(caps, totals_of_card, t, charges[i])
+        session_start[i] = start
+        paid_zones[i] = paid
+    if active:
+        opened[card] = FareSession(start, paid)
+    if totals_of_card is not None:
+        totals[card] = totals_of_card
+
+    return TapCharges(charges, session_start, paid_zones, opened, totals)
+
+
+#_____________________________________________________________________________
+# Streaming tap rating (python main.py rate-taps [file])
+# ____________________________________________________________________________
+
+@dataclass(frozen = True, slots = True)
+class TapEvent:
+    card: int
+    minute: int            # minutes since the start of the log (may run past midnight)
+    required_zones: int
+    concession: str = ""   # FareTable names; "" = the table's first one
+    product: str = ""
+
+
+@dataclass(frozen = True, slots = True)
+class RatedTap:
+    tap: TapEvent
+    charge: float
+    session: FareSession
+    capped_off: float = 0.0    # part of the transfer-window charge waived by a fare cap
+
+
+def read_taps(source: Union[str, Path, Iterable[str]]) -> Iterator[TapEvent]:
+    """
+    Tap events from a JSONL or CSV file, "-" for stdin, or any iterable of lines.
+    JSONL: {"card": 17, "minute": 512, "required_zones": 2} per line.
+    CSV: header row with card,minute,required_zones. Blank lines are skipped.
+    Optional concession / product fields pick the fare type (see FareTable).
+    Lines are read lazily, so this works on logs of any size and on live pipes.
+    """
+    if source == "-":
+        yield from read_taps(sys.stdin)
+        return
+    if isinstance(source, (str, Path)):
+        with Path(source).open(newline = "") as f:
+            yield from read_taps(f)
+        return
+
+    lines = (line for line in source if line.strip())
+    first = next(lines, None)
+    if first is None:
+        return
+    lines = chain([first], lines)
+    if first.lstrip().startswith("{"):
+        rows: Iterable[dict] = (json.loads(line) for line in lines)
+    else:
+        rows = csv.DictReader(lines)
+    for row in rows:
+        yield TapEvent(
+            int(row["card"]),
+            int(row["minute"]),
+            int(row["required_zones"]),
+            row.get("concession") or "",
+            row.get("product") or "",
+        )
+
+
+class TapStream:
+    """
+    Rates taps one at a time as they arrive with compute_fare_with_transfer_window,
+    keeping a FareSession only for cards whose transfer window is still open.
+    Sessions are queued in a heap by expiry minute and dropped once the stream's clock
+    (latest tap minute seen) has passed it, so memory follows active riders rather than
+    every card ever seen. Taps should arrive in time order; a tap up to max_lateness
+    minutes older than the clock is still rated against its card's open session.
+    With caps, charges also go through apply_fare_cap; those totals are kept until
+    the card's service week (or day) is over. With fare_table, taps are priced by the
+    table (their concession / product names picking the row) instead of zone_fares and
+    window_minutes, and sessions are kept for the longest product window.
+    """
+
+    def __init__(
+        self,
+        zone_fares: Dict[int, float],
+        window_minutes: int,
+        max_lateness: int = 0,
+        sessions: Optional[SessionStore] = None,
+        caps: Optional[FareCaps] = None,
+        fare_table: Optional[FareTable] = None
+    ) -> None:
+        self.zone_fares = zone_fares
+        self.window_minutes = window_minutes
+        self.fare_table = fare_table
+        if fare_table is not None:
+            self._concession_ids = {"": 0, **{name: i for i, name in enumerate(fare_table.concessions)}}
+            self._product_ids = {"": 0, **{name: i for i, name in enumerate(fare_table.products)}}
+            self._keep_minutes = max(fare_table.windows)
+        else:
+            self._keep_minutes = window_minutes
+        self.max_lateness = max_lateness
+        # A dict unless given a SessionStore (for very many concurrently open cards)
+        self.sessions: Union[Dict[int, FareSession], SessionStore] = sessions if sessions is not None else {}
+        self.caps = caps
+        # Cap totals live until their service week (or day, without a weekly cap) is over
+        self.cap_states: Dict[int, CapState] = {}
+        self._cap_expiry: List[Tuple[int, int, int]] = []    # (last minute of the period, card, day)
+        self._expiry: List[Tuple[int, int, int]] = []   # (expires after minute, card, session start)
+        self.clock: Optional[int] = None
+        self.taps = 0
+        self.evicted = 0
+        self.peak_sessions = 0
+        self.revenue = 0.0
+        self.capped_off = 0.0
+        self.busy_seconds = 0.0
+
+    @property
+    def live_sessions(self) -> int:
+        return len(self.sessions)
+
+    @property
+    def taps_per_second(self) -> float:
+        return self.taps / self.busy_seconds if self.busy_seconds else 0.0
+
+    def _evict(self) -> None:
+        horizon = self.clock - self.max_lateness
+        heap = self._expiry
+        while heap and heap[0][0] < horizon:
+            _, card, start = heapq.heappop(heap)
+            session = self.sessions.get(card)
+            # Skip entries left behind by a session that was replaced since
+            if session is not None and session.start_minute == start:
+                del self.sessions[card]
+                self.evicted += 1
+
+        heap = self._cap_expiry
+        while heap and heap[0][0] < horizon:
+            _, card, period = heapq.heappop(heap)
+            state = self.cap_states.get(card)
+            if state is not None and self._cap_period(state)[0] == period:
+                del self.cap_states[card]
+
+    def _cap_period(self, state: CapState) -> Tuple[int, int]:
+        # (period id, last minute of it) for the longest cap in force
+        if self.caps.weekly is not None:
+            return state.week, (state.week + 1) * 7 * 1440 + self.caps.service_day_start - 1
+        return state.day, (state.day + 1) * 1440 + self.caps.service_day_start - 1
+
+    def rate(self, tap: TapEvent) -> RatedTap:
+        began = time.perf_counter()
+        if self.clock is None or tap.minute > self.clock:
+            self.clock = tap.minute
+            self._evict()
+
+        before = self.sessions.get(tap.card)
+        if self.fare_table is None:
+            charge, session = compute_fare_with_transfer_window(
+                session = before,
+                trip_time_minute = tap.minute,
+                required_zones = tap.required_zones,
+                zone_fares = self.zone_fares,
+                window_minutes = self.window_minutes
+            )
+        else:
+            concession = self._concession_ids.get(tap.concession)
+            product = self._product_ids.get(tap.product)
+            if concession is None or product is None:
+                raise ValueError(f"Unknown concession or product on tap: {tap}")
+            charge, session = self.fare_table.rate_level(before, tap.minute, tap.required_zones, concession, product)
+        self.sessions[tap.card] = session
+        if before is None or session.start_minute != before.start_minute:
+            heapq.heappush(self._expiry, (session.start_minute + self._keep_minutes, tap.card, session.start_minute))
+            if len(self.sessions) > self.peak_sessions:
+                self.peak_sessions = len(self.sessions)
+
+        capped_off = 0.0
+        if self.caps is not None:
+            prior = self.cap_states.get(tap.card)
+            old_period = self._cap_period(prior)[0] if prior is not None else None
+            capped, state = apply_fare_cap(self.caps, prior, tap.minute, charge)
+            self.cap_states[tap.card] = state
+            period, last_minute = self._cap_period(state)
+            if period != old_period:
+                heapq.heappush(self._cap_expiry, (last_minute, tap.card, period))
+            capped_off = charge - capped
+            charge = capped
+            self.capped_off += capped_off
+
+        self.taps += 1
+        self.revenue += charge
+        self.busy_seconds += time.perf_counter() - began
+        return RatedTap(tap, charge, session, capped_off)
+
+    def process(self, taps: Iterable[TapEvent]) -> Iterator[RatedTap]:
+        for tap in taps:
+            yield self.rate(tap)
+
+    def metrics(self) -> Dict[str, float]:
+        return {
+            "taps": self.taps,
+            "taps_per_second": self.taps_per_second,
+            "live_sessions": self.live_sessions,
+            "peak_sessions": self.peak_sessions,
+            "evicted_sessions": self.evicted,
+            "cap_totals": len(self.cap_states),
+            "revenue": self.revenue,
+            "capped_off": self.capped_off,
+        }
+
+
+def rate_taps_cli(source: str = "-") -> None:
+    """
+    python main.py rate-taps [file]: rates a JSONL/CSV tap log (stdin by default) and
+    writes one JSON line per tap to stdout; metrics go to stderr every 100k taps and at the end.
+    """
+    data_dir = Path(__file__).parent / "data"
+    _, _, zone_fares, _, window_minutes = load_network(data_dir)
+    stream = TapStream(
+        zone_fares,
+        window_minutes,
+        caps = load_fare_caps(data_dir),
+        fare_table = load_fare_table(data_dir),
+    )
+    out = sys.stdout
+    for rated in stream.process(read_taps(source)):
+        out.write(json.dumps({
+            "card": rated.tap.card,
+            "minute": rated.tap.minute,
+            "charge": round(rated.charge, 2),
+            "paid_zones": rated.session.paid_zones,
+        }) + "\n")
+        if stream.taps % 100_000 == 0:
+            print(json.dumps(stream.metrics()), file = sys.stderr)
+    print(json.dumps(stream.metrics()), file = sys.stderr)
+
+
+#_____________________________________________________________________________
+# Compact session store (millions of cards)
+# ____________________________________________________________________________
+
+_SLOT_EMPTY = 0
+_SLOT_USED = 1
+_SLOT_DELETED = 2   # tombstone: keeps probe chains intact after a delete
+
+class SessionStore:
+    """
+    Card id -> FareSession without a Python object per card: open addressing with
+    linear probing over parallel typed arrays (int64 keys, start minutes, paid zones).
+    Drop-in for the dict of sessions the fare code uses: get() returns a FareSession
+    (built on the fly) or None, update() / store[card] = session writes one back.
+    Grows at 70% load (tombstones included) and rebuilds without the tombstones.
+    """
+
+    def __init__(self, capacity: int = 1024) -> None:
+        size = 8
+        while size * 7 < capacity * 10:
+            size *= 2
+        self._alloc(size)
+
+    def _alloc(self, size: int) -> None:
+        self._mask = size - 1
+        self._keys = array("q", [0]) * size
+        self._starts = array("q", [0]) * size
+        self._paid = array("l", [0]) * size
+        self._state = bytearray(size)
+        self._count = 0
+        self._filled = 0    # used + tombstones
+
+    def _probe(self, card: int) -> Tuple[int, bool]:
+        # (slot of card, True) if present, else (slot to insert at, False)
+        h = (card * 0x9E3779B97F4A7C15) & 0xFFFFFFFFFFFFFFFF
+        i = (h ^ (h >> 29)) & self._mask
+        state, keys = self._state, self._keys
+        free = -1
+        while True:
+            s = state[i]
+            if s == _SLOT_EMPTY:
+                return (free if free != -1 else i), False
+            if s == _SLOT_USED:
+                if keys[i] == card:
+                    return i, True
+            elif free == -1:
+                free = i
+            i = (i + 1) & self._mask
+
+    def get(self, card: int, default: Optional[FareSession] = None) -> Optional[FareSession]:
+        i, found = self._probe(card)
+        if not found:
+            return default
+        return FareSession(self._starts[i], self._paid[i])
+
+    def update(self, card: int, session: FareSession) -> None:
+        i, found = self._probe(card)
+        if not found:
+            if self._state[i] == _SLOT_EMPTY:
+                if (self._filled + 1) * 10 > (self._mask + 1) * 7:
+                    self._resize()
+                    i, _ = self._probe(card)
+                self._filled += 1
+            self._state[i] = _SLOT_USED
+            self._keys[i] = card
+            self._count += 1
+        self._starts[i] = session.start_minute
+        self._paid[i] = session.paid_zones
+
+    __setitem__ = update
+
+    def __getitem__(self, card: int) -> FareSession:
+        session = self.get(card)
+        if session is None:
+            raise KeyError(card)
+        return session
+
+    def __delitem__(self, card: int) -> None:
+        i, found = self._probe(card)
+        if not found:
+            raise KeyError(card)
+        self._state[i] = _SLOT_DELETED
+        self._count -= 1
+
+    def __contains__(self, card: int) -> bool:
+        return self._probe(card)[1]
+
+    def __len__(self) -> int:
+        return self._count
+
+    def items(self) -> Iterator[Tuple[int, FareSession]]:
+        for i, s in enumerate(self._state):
+            if s == _SLOT_USED:
+                yield self._keys[i], FareSession(self._starts[i], self._paid[i])
+
+    def _resize(self) -> None:
+        old = (self._keys, self._starts, self._paid, self._state)
+        size = self._mask + 1
+        # Only double when it's real entries filling the table, not tombstones
+        if self._count * 10 > size * 7 // 2:
+            size *= 2
+        self._alloc(size)
+        keys, starts, paid, state = old
+        for i, s in enumerate(state):
+            if s == _SLOT_USED:
+                j, _ = self._probe(keys[i])
+                self._state[j] = _SLOT_USED
+                self._keys[j] = keys[i]
+                self._starts[j] = starts[i]
+                self._paid[j] = paid[i]
+        self._count = self._filled = sum(1 for s in state if s == _SLOT_USED)
+
+    def nbytes(self) -> int:
+        return sum(buf.itemsize * len(buf) for buf in (self._keys, self._starts, self._paid)) + len(self._state)
+
+
+#_____________________________________________________________________________
+# Benchmarks (python main.py bench)
+# ____________________________________________________________________________
+
+def synthetic_network(n_stations: int, seed: int = 0) -> Tuple[Dict[str, Station], Dict[str, List[Edge]]]:
+    """
+    Grid-shaped test network of about n_stations stations: every row and column is a
+    TRAIN line with 1-5 minute hops, plus some random BUS links. Zones grow with the
+    distance from the top-left corner, like a downtown-centred system.
+    """
+    rng = random.Random(seed)
+    side = max(2, int(n_stations ** 0.5))
+    stations: Dict[str, Station] = {}
+    for r in range(side):
+        for c in range(side):
+            sid = f"S{r:04d}_{c:04d}"
+            stations[sid] = Station(sid, sid, 1 + (3 * (r + c)) // (2 * side))
+
+    graph: Dict[str, List[Edge]] = {sid: [] for sid in stations}
+
+    def link(a: str, b: str, minutes: int, line: str, mode: str) -> None:
+        graph[a].append(Edge(b, minutes, line, mode))
+        graph[b].append(Edge(a, minutes, line, mode))
+
+    for r in range(side):
+        for c in range(side):
+            here = f"S{r:04d}_{c:04d}"
+            if c + 1 < side:
+                link(here, f"S{r:04d}_{c + 1:04d}", rng.randint(1, 5), f"Row {r}", "TRAIN")
+            if r + 1 < side:
+                link(here, f"S{r + 1:04d}_{c:04d}", rng.randint(1, 5), f"Column {c}", "TRAIN")
+
+    ids = list(stations)
+    for i in range(len(ids) // 10):
+        a, b = rng.sample(ids, 2)
+        link(a, b, rng.randint(5, 30), f"Bus {i}", "BUS")
+
+    return stations, graph
+
+
+def benchmark_routing(
+    n_stations: int = 10_000,
+    queries: int = 200,
+    seed: int = 0,
+    algorithms: Sequence[str] = ROUTING_ALGORITHMS
+) -> Dict[str, float]:
+    """
+    Times dijkstra_path on a synthetic network with each algorithm on the same random
+    queries and returns the average microseconds per query, once on the compiled graph
+    and once on the dict graph ("<algorithm>/dict", including the one-off compile).
+    Also checks that every algorithm finds the same travel times.
+    """
+    _, graph = synthetic_network(n_stations, seed)
+    cg = compile_graph(graph)
+    rng = random.Random(seed)
+    pairs = [(rng.choice(cg.ids), rng.choice(cg.ids)) for _ in range(queries)]
+
+    print(f"\nSynthetic network: {len(cg.ids)} stations, {len(cg.targets)} directed edges, {queries} queries")
+    timings: Dict[str, float] = {}
+    reference: Optional[List[Optional[int]]] = None
+    for algorithm in algorithms:
+        for name, g in ((algorithm, cg), (f"{algorithm}/dict", graph)):
+            forget_compiled(graph)
+            began = time.perf_counter()
+            results = [dijkstra_path(g, a, b, algorithm = algorithm) for a, b in pairs]
+            elapsed = time.perf_counter() - began
+
+            found = [r[1] if r else None for r in results]
+            if reference is None:
+                reference = found
+            elif found != reference:
+                raise AssertionError(f"{name} disagrees with {algorithms[0]} on travel times")
+
+            timings[name] = elapsed / queries * 1e6
+            print(f" {name:<19} {timings[name]:10.1f} us/query")
+    return timings
+
+
+def benchmark_session_memory(n_cards: int = 1_000_000, seed: int = 0) -> Dict[str, int]:
+    """
+    Traced memory (tracemalloc) of n_cards sessions in a dict of FareSession objects
+    vs a SessionStore, with random 64-bit card ids.
+    """
+    rng = random.Random(seed)
+    cards = [rng.getrandbits(63) for _ in range(n_cards)]
+    sizes: Dict[str, int] = {}
+
+    tracemalloc.start()
+    as_dict = {}
+    for i, card in enumerate(cards):
+        as_dict[card] = FareSession(i % 1440, 1 + i % 3)
+    sizes["dict"] = tracemalloc.get_traced_memory()[0]
+    del as_dict
+    tracemalloc.stop()
+
+    tracemalloc.start()
+    store = SessionStore()
+    for i, card in enumerate(cards):
+        store.update(card, FareSession(i % 1440, 1 + i % 3))
+    sizes["store"] = tracemalloc.get_traced_memory()[0]
+    del store
+    tracemalloc.stop()
+
+    print(f"\n{n_cards} sessions: dict of FareSession {sizes['dict'] / 2**20:.1f} MiB,"
+          f" SessionStore {sizes['store'] / 2**20:.1f} MiB")
+    return sizes
+
+
 #_____________________________________________________________________________
 # Main demo
 # ____________________________________________________________________________
 
 def main() -> None: 
     data_dir = Path(__file__).parent / "data"
-    stations, graph, zone_fares, bus_flat, window_minutes = load_network(data_dir)
+    stations, graph, _, _, _ = load_network(data_dir)
+    fare_table = load_fare_table(data_dir)
 
     # This persists across trips, so transfer window works across multiple rides
     session: Optional[FareSession] = None
 
+    concession = get_fare_choice("Fare type", fare_table.concessions)
+    product = get_fare_choice("Ticket", fare_table.products)
+    window_minutes = fare_table.windows[product]
+
     while True:
         print_stations(stations)
 
@@ -351,27 +4447,20 @@ def main() -> None:
             print("\nNo travel - same origin and destination.")
             print("Fare: $0.00")
         else:
-            result = dijkstra_path(graph, start, goal) 
-            if not result:
+            route = plan_route(graph, stations, start, goal) 
+            if not route:
                 print("\nNo route found.")
             else:
-                path, minutes = result
+                path = route.path
+                required = fare_table.required_zones(route.mode, route.zones_crossed, trip_time, concession)
 
-                lines_each_segment = segment_lines(graph, path)
-                lines_used = unique_lines_in_order(lines_each_segment)
-                transfers = transfer_stations(path, lines_each_segment)
-
-                
-                z = zones_crossed(stations, path)
-                mode = infer_mode_for_path(graph, path)
-                required = trip_required_zones(mode, z)
-
-                charge, session = compute_fare_with_transfer_window(
+                charge, session = fare_table.rate(
                     session = session,
-                    trip_time_minute= trip_time,
-                    required_zones= required, 
-                    zone_fares = zone_fares,
-                    window_minutes= window_minutes
+                    trip_time_minute = trip_time,
+                    mode = route.mode,
+                    zones = route.zones_crossed,
+                    concession = concession,
+                    product = product
                 )
 
                 path_names = " -> ".join(stations[s].name for s in path)
@@ -384,10 +4473,10 @@ def main() -> None:
 
                 print("\nRoute: ")
                 print(path_names)
-                print(f"Total travel time: {minutes} min")
+                print(f"Total travel time: {route.minutes} min")
 
-                print(f"Zones crossed: (route): {z}")
-                print(f"Mode:(simple): {mode}")
+                print(f"Zones crossed: (route): {route.zones_crossed}")
+                print(f"Mode:(simple): {route.mode}")
                 print(f"Required fare level: {required} zone(s)")
                 print(f"Charged now: ${charge:.2f}")
 
@@ -397,16 +4486,15 @@ def main() -> None:
                           f" (paid up to {session.paid_zones} zone(s))")
 
                 print("\nSegments: ")
-                for a, b in zip(path, path[1:]):
-                    e = edge_info(graph, a, b)
+                for a, b, e in zip(path, path[1:], route.edges):
                     print(f" - {stations[a].name} -> {stations[b].name} ({e.line})")
 
                 print("\nLines traveled: ")
-                print(" -> ".join(lines_used))
+                print(" -> ".join(route.lines))
 
-                if transfers:
+                if route.transfers:
                     print("\nTransfers at: ")
-                    for sid in transfers: 
+                    for sid in route.transfers: 
                         print(f" - {stations[sid].name}")
 
         again = input("\nPlan another trip? (y/n): ").strip().lower()
@@ -415,4 +4503,11 @@ def main() -> None:
             break          
 
 if __name__ == "__main__":
-    main()
\ No newline at end of file
+    if sys.argv[1:2] == ["bench"]:
+        benchmark_routing()
+    elif sys.argv[1:2] == ["bench-sessions"]:
+        benchmark_session_memory()
+    elif sys.argv[1:2] == ["rate-taps"]:
+        rate_taps_cli(sys.argv[2] if len(sys.argv) > 2 else "-")
+    else:
+        main()
\ No newline at end of file
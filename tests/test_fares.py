@@ -0,0 +1,236 @@
+import json
+import random
+import shutil
+import sys
+import tempfile
+import unittest
+from array import array
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).resolve().parents[1]))
+
+from main import (  # noqa: E402
+    FareCaps,
+    FareSession,
+    SessionStore,
+    TapEvent,
+    TapStream,
+    apply_fare_cap,
+    compile_fare_rules,
+    compute_fare_with_transfer_window,
+    legacy_fare_rules,
+    load_network,
+    rate_taps,
+    read_taps,
+)
+
+DATA_DIR = Path(__file__).resolve().parents[1] / "data"
+ZONE_FARES = {1: 2.50, 2: 3.75, 3: 4.90}
+WINDOW = 90
+RULES = {
+    "concessions": ["adult", "senior"],
+    "products": {"card": 90, "paper": 30},
+    "rules": [
+        {"zones": 1, "price": 2.50},
+        {"zones": 2, "price": 3.75},
+        {"zones": [3, 4], "price": 4.90},
+        {"band": "peak", "zones": [2, 4], "multiply": 1.2},
+        {"concession": "senior", "multiply": 0.5},
+    ],
+}
+BANDS = {"peak": ["07:00", "09:00"]}
+
+
+def random_taps(seed, n, cards = 6, minutes = 3000):
+    rng = random.Random(seed)
+    return (
+        [rng.randrange(-2, cards) for _ in range(n)],
+        [rng.randrange(minutes) for _ in range(n)],
+        [rng.randint(1, 4) for _ in range(n)],
+    )
+
+
+def scalar_charges(cards, minutes, required, sessions = None):
+    """
+    compute_fare_with_transfer_window tap by tap, each card in time order
+    (same-minute taps in input order). Returns (charges by input position, sessions).
+    """
+    sessions = dict(sessions or {})
+    charges = {}
+    for i in sorted(range(len(cards)), key = lambda i: (cards[i], minutes[i], i)):
+        charges[i], sessions[cards[i]] = compute_fare_with_transfer_window(
+            sessions.get(cards[i]), minutes[i], required[i], ZONE_FARES, WINDOW
+        )
+    return [charges[i] for i in range(len(cards))], sessions
+
+
+class RateTapsTests(unittest.TestCase):
+    def test_matches_scalar_function(self):
+        for seed in range(50):
+            cards, minutes, required = random_taps(seed, random.Random(seed).randint(0, 80))
+            result = rate_taps(cards, minutes, required, ZONE_FARES, WINDOW)
+            expected, sessions = scalar_charges(cards, minutes, required)
+            self.assertEqual(list(result.charges), expected)
+            self.assertEqual(result.sessions, sessions)
+            self.assertEqual(len(result.paid_zones), len(cards))
+            self.assertEqual(len(result.session_start), len(cards))
+
+    def test_columnar_arrays_and_open_sessions(self):
+        cards, minutes, required = random_taps(7, 200)
+        opened = {0: FareSession(-30, 2), 1: FareSession(2990, 3)}
+        result = rate_taps(array("q", cards), array("q", minutes), array("l", required), ZONE_FARES, WINDOW, opened)
+        expected, sessions = scalar_charges(cards, minutes, required, opened)
+        self.assertEqual(list(result.charges), expected)
+        self.assertEqual(result.sessions, sessions)
+        self.assertEqual(opened, {0: FareSession(-30, 2), 1: FareSession(2990, 3)})
+
+    def test_mismatched_columns(self):
+        with self.assertRaises(ValueError):
+            rate_taps([1, 2], [0], [1, 1], ZONE_FARES, WINDOW)
+
+
+class TapStreamTests(unittest.TestCase):
+    def time_ordered_taps(self, seed, n = 3000):
+        cards, minutes, required = random_taps(seed, n, cards = 400, minutes = 2000)
+        return sorted((TapEvent(c, m, z) for c, m, z in zip(cards, minutes, required)), key = lambda t: t.minute)
+
+    def test_matches_scalar_function(self):
+        for sessions in (None, SessionStore(16)):
+            taps = self.time_ordered_taps(1)
+            stream = TapStream(ZONE_FARES, WINDOW, sessions = sessions)
+            rated = list(stream.process(taps))
+            expected, _ = scalar_charges([t.card for t in taps], [t.minute for t in taps], [t.required_zones for t in taps])
+            self.assertEqual([r.charge for r in rated], expected)
+            self.assertEqual(stream.taps, len(taps))
+
+    def test_expired_sessions_are_evicted(self):
+        taps = self.time_ordered_taps(2)
+        stream = TapStream(ZONE_FARES, WINDOW)
+        for i, _ in enumerate(stream.process(taps)):
+            # Only sessions whose window is still open at the stream clock are held
+            if i % 50 == 0:
+                for session in stream.sessions.values():
+                    self.assertLessEqual(stream.clock - session.start_minute, WINDOW)
+        self.assertGreater(stream.evicted, 0)
+        self.assertLess(stream.peak_sessions, 400)
+        self.assertEqual(stream.metrics()["live_sessions"], len(stream.sessions))
+
+    def test_read_taps_jsonl_and_csv(self):
+        taps = self.time_ordered_taps(3, 20)
+        jsonl = [f'{{"card": {t.card}, "minute": {t.minute}, "required_zones": {t.required_zones}}}\n' for t in taps]
+        csv_lines = ["card,minute,required_zones\n"] + [f"{t.card},{t.minute},{t.required_zones}\n" for t in taps]
+        self.assertEqual(list(read_taps(jsonl + ["\n"])), taps)
+        self.assertEqual(list(read_taps(csv_lines)), taps)
+        self.assertEqual(list(read_taps([])), [])
+
+
+class FareTableTests(unittest.TestCase):
+    def test_legacy_table_matches_scalar_function(self):
+        table = compile_fare_rules(legacy_fare_rules(ZONE_FARES, WINDOW))
+        cards, minutes, required = random_taps(8, 400)
+        order = sorted(range(len(cards)), key = lambda i: (cards[i], minutes[i]))
+        sessions, expected, got = {}, {}, {}
+        for i in order:
+            expected[i], sessions[cards[i]] = compute_fare_with_transfer_window(
+                sessions.get(cards[i]), minutes[i], required[i], ZONE_FARES, WINDOW
+            )
+        sessions = {}
+        for i in order:
+            got[i], sessions[cards[i]] = table.rate_level(sessions.get(cards[i]), minutes[i], required[i])
+        self.assertEqual(got, expected)
+        self.assertEqual(table.flat_fares(), ({1: 2.5, 2: 3.75, 3: 4.9}, 2.5, WINDOW))
+
+    def test_rate_taps_and_stream_use_table(self):
+        table = compile_fare_rules(RULES, BANDS)
+        cards, minutes, required = random_taps(9, 600, cards = 8, minutes = 1440)
+        rng = random.Random(9)
+        concessions = [rng.randrange(2) for _ in cards]
+        products = [rng.randrange(2) for _ in cards]
+        order = sorted(range(len(cards)), key = lambda i: (minutes[i], i))
+        cards, minutes, required, concessions, products = (
+            [col[i] for i in order] for col in (cards, minutes, required, concessions, products)
+        )
+
+        sessions, expected = {}, []
+        for i in range(len(cards)):
+            charge, sessions[cards[i]] = table.rate_level(
+                sessions.get(cards[i]), minutes[i], required[i], concessions[i], products[i]
+            )
+            expected.append(charge)
+        # Senior, peak and product windows all change some charges
+        self.assertNotEqual(expected, scalar_charges(cards, minutes, required)[0])
+
+        batch = rate_taps(
+            cards, minutes, required, ZONE_FARES, WINDOW,
+            fare_table = table, concessions = concessions, products = products
+        )
+        self.assertEqual(list(batch.charges), expected)
+
+        stream = TapStream(ZONE_FARES, WINDOW, fare_table = table)
+        rated = [
+            stream.rate(TapEvent(c, m, z, table.concessions[k], table.products[p]))
+            for c, m, z, k, p in zip(cards, minutes, required, concessions, products)
+        ]
+        self.assertEqual([r.charge for r in rated], expected)
+        with self.assertRaises(ValueError):
+            stream.rate(TapEvent(1, 1500, 1, "student"))
+
+    def test_shipped_rules_drive_flat_fares(self):
+        self.assertEqual(load_network(DATA_DIR)[2:], ({1: 2.5, 2: 3.75, 3: 4.9}, 2.5, 60))
+
+    def test_zone_fares_disagreeing_with_rules_are_rejected(self):
+        tmp = tempfile.TemporaryDirectory()
+        self.addCleanup(tmp.cleanup)
+        data_dir = Path(tmp.name) / "data"
+        shutil.copytree(DATA_DIR, data_dir)
+        fares = json.loads((data_dir / "fares.json").read_text())
+        fares["zone_fares"] = {"1": 2.5, "2": 3.75, "3": 5.0}
+        (data_dir / "fares.json").write_text(json.dumps(fares))
+        with self.assertRaises(ValueError):
+            load_network(data_dir)
+        fares["zone_fares"]["3"] = 4.9
+        (data_dir / "fares.json").write_text(json.dumps(fares))
+        self.assertEqual(load_network(data_dir)[2], ZONE_FARES)
+
+
+class FareCapTests(unittest.TestCase):
+    def test_batch_and_stream_agree_with_running_totals(self):
+        for caps in (FareCaps(daily = 7.0), FareCaps(weekly = 20.0, service_day_start = 180), FareCaps(daily = 11.25, weekly = 56.0)):
+            cards, minutes, required = random_taps(4, 400, cards = 5, minutes = 20000)
+            order = sorted(range(len(cards)), key = lambda i: minutes[i])
+            cards, minutes, required = ([col[i] for i in order] for col in (cards, minutes, required))
+
+            batch = rate_taps(cards, minutes, required, ZONE_FARES, WINDOW, caps = caps)
+            stream = TapStream(ZONE_FARES, WINDOW, caps = caps)
+            rated = [stream.rate(TapEvent(c, m, z)) for c, m, z in zip(cards, minutes, required)]
+            self.assertEqual([r.charge for r in rated], list(batch.charges))
+
+            uncapped, _ = scalar_charges(cards, minutes, required)
+            states, expected = {}, []
+            for i, charge in enumerate(uncapped):
+                capped, states[cards[i]] = apply_fare_cap(caps, states.get(cards[i]), minutes[i], charge)
+                expected.append(capped)
+                self.assertAlmostEqual(rated[i].capped_off, charge - capped)
+            self.assertEqual(list(batch.charges), expected)
+
+    def test_service_day_crosses_midnight(self):
+        caps = FareCaps(daily = 5.0, service_day_start = 240)
+        state = None
+        charges = []
+        for minute in (23 * 60, 24 * 60 + 30, 24 * 60 + 4 * 60):
+            charge, state = apply_fare_cap(caps, state, minute, 4.0)
+            charges.append(charge)
+        self.assertEqual(charges, [4.0, 1.0, 4.0])
+
+    def test_rate_taps_leaves_cap_states_untouched(self):
+        caps = FareCaps(daily = 6.35)
+        first = rate_taps([1], [600], [3], ZONE_FARES, WINDOW, caps = caps)
+        prev = first.cap_states
+        again = [rate_taps([1], [800], [3], ZONE_FARES, WINDOW, caps = caps, cap_states = prev) for _ in range(2)]
+        self.assertEqual(list(again[0].charges), [1.45])
+        self.assertEqual(list(again[1].charges), [1.45])
+        self.assertEqual(prev[1].day_spent, 4.90)
+
+
+if __name__ == "__main__":
+    unittest.main()
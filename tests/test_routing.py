@@ -0,0 +1,104 @@
+import random
+import struct
+import sys
+import tempfile
+import unittest
+from pathlib import Path
+from unittest import mock
+
+sys.path.insert(0, str(Path(__file__).resolve().parents[1]))
+
+from main import (  # noqa: E402
+    ROUTING_ALGORITHMS,
+    LiveNetwork,
+    _as_compiled,
+    build_travel_matrix,
+    compile_graph,
+    dijkstra_path,
+    forget_compiled,
+    k_shortest_routes,
+    load_network,
+    load_travel_matrix,
+    matrix_path,
+    pareto_routes,
+    save_travel_matrix,
+    synthetic_network,
+)
+
+DATA_DIR = Path(__file__).resolve().parents[1] / "data"
+
+
+class CompiledGraphCacheTests(unittest.TestCase):
+    def setUp(self):
+        self.addCleanup(forget_compiled)
+
+    def test_dict_graph_is_compiled_once(self):
+        _, graph = synthetic_network(300, seed = 1)
+        cg = _as_compiled(graph)
+        self.assertIs(_as_compiled(graph), cg)
+        forget_compiled(graph)
+        self.assertIsNot(_as_compiled(graph), cg)
+
+    def test_engines_agree_on_dict_and_compiled_graphs(self):
+        _, graph = synthetic_network(500, seed = 2)
+        cg = compile_graph(graph)
+        rng = random.Random(2)
+        for _ in range(50):
+            a, b = rng.choice(cg.ids), rng.choice(cg.ids)
+            expected = dijkstra_path(graph, a, b)
+            for algorithm in ROUTING_ALGORITHMS:
+                for g in (graph, cg):
+                    found = dijkstra_path(g, a, b, algorithm = algorithm)
+                    self.assertEqual(found[1] if found else None, expected[1] if expected else None, (algorithm, a, b))
+
+    def test_pareto_routes_reuse_compiled_graph(self):
+        stations, graph, zone_fares, _, window = load_network(DATA_DIR)
+        first = pareto_routes(graph, stations, "WFR", "CMB", zone_fares, window)
+        with mock.patch("main.compile_graph", side_effect = AssertionError("recompiled")):
+            again = pareto_routes(graph, stations, "WFR", "CMB", zone_fares, window)
+        self.assertEqual(again, first)
+        self.assertTrue(first)
+
+    def test_k_shortest_routes_reuse_compiled_graph(self):
+        stations, graph = load_network(DATA_DIR)[:2]
+        first = k_shortest_routes(graph, stations, "WFR", "CMB", 4)
+        with mock.patch("main.compile_graph", side_effect = AssertionError("recompiled")):
+            again = k_shortest_routes(graph, stations, "WFR", "CMB", 4)
+        self.assertEqual([r.path for r in again], [r.path for r in first])
+        self.assertEqual(len(first), 4)
+
+    def test_live_edits_reach_dict_graph_queries(self):
+        stations, graph, zone_fares, bus_flat, _ = load_network(DATA_DIR)
+        live = LiveNetwork(stations, graph, zone_fares, bus_flat)
+        a, b = "WFR", "CMB"
+        before = dijkstra_path(live.graph, a, b, algorithm = "dial")
+        live.add_edge(a, b, 1, "Shuttle", "BUS")
+        for algorithm in ROUTING_ALGORITHMS:
+            self.assertEqual(dijkstra_path(live.graph, a, b, algorithm = algorithm), ([a, b], 1))
+        self.assertGreater(before[1], 1)
+
+
+class TravelMatrixFileTests(unittest.TestCase):
+    def test_round_trip_with_fixed_width_little_endian_columns(self):
+        stations, graph, zone_fares, bus_flat, _ = load_network(DATA_DIR)
+        tm = build_travel_matrix(graph, stations, zone_fares, bus_flat)
+        tmp = tempfile.TemporaryDirectory()
+        self.addCleanup(tmp.cleanup)
+        path = Path(tmp.name) / "matrix.bin"
+        save_travel_matrix(tm, path)
+
+        raw = path.read_bytes()
+        cells = len(tm.ids) ** 2
+        self.assertEqual(raw[-cells * (8 + 4 * 3 + 8):][:8], struct.pack("<q", tm.minutes[0]))
+        prev_at = len(raw) - cells * (4 * 3 + 8)
+        self.assertEqual(list(struct.unpack(f"<{cells}i", raw[prev_at:prev_at + 4 * cells])), list(tm.prev))
+
+        loaded = load_travel_matrix(path)
+        for field in ("ids", "minutes", "prev", "zones", "required", "fares"):
+            self.assertEqual(list(getattr(loaded, field)), list(getattr(tm, field)), field)
+        self.assertEqual(loaded.prev.typecode, tm.prev.typecode)
+        self.assertEqual(matrix_path(loaded, "WFR", "CMB"), dijkstra_path(graph, "WFR", "CMB"))
+
+
+if __name__ == "__main__":
+    unittest.main()
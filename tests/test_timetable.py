@@ -0,0 +1,243 @@
+import json
+import random
+import sys
+import tempfile
+import unittest
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).resolve().parents[1]))
+
+from main import (  # noqa: E402
+    UNREACHED,
+    build_connections,
+    csa_earliest_arrival,
+    csa_profile,
+    load_network,
+    load_timetable,
+    raptor_earliest_arrival,
+    raptor_range_query,
+    timetable_from_network,
+)
+
+DATA_DIR = Path(__file__).resolve().parents[1] / "data"
+
+
+def reference_arrivals(routes, source, departure):
+    """
+    Earliest arrival at every stop by relaxing every trip until nothing changes
+    (no transfer time). Slow, but independent of the timetable engines.
+    """
+    arrival = {source: departure}
+    changed = True
+    while changed:
+        changed = False
+        for stops, trips in routes:
+            for trip in trips:
+                boarded = False
+                for sid, minute in zip(stops, trip):
+                    if boarded and minute < arrival.get(sid, UNREACHED):
+                        arrival[sid] = minute
+                        changed = True
+                    if arrival.get(sid, UNREACHED) <= minute:
+                        boarded = True
+    return arrival
+
+
+def temp_dir(test):
+    tmp = tempfile.TemporaryDirectory()
+    test.addCleanup(tmp.cleanup)
+    return Path(tmp.name)
+
+
+def random_timetable(stations, seed, overtaking, directory):
+    """
+    (routes for reference_arrivals, path of a timetable json written to directory). Run
+    times differ between trips; with overtaking later trips can pass earlier ones,
+    otherwise a trip is held back so it never gets anywhere before the one in front of it.
+    """
+    rng = random.Random(seed)
+    ids = sorted(stations)[:10]
+    routes, rows = [], []
+    for r in range(8):
+        stops = rng.sample(ids, rng.randint(2, 5))
+        trips = []
+        for start in range(300, 700, rng.randint(15, 40)):
+            trip, minute = [], start + rng.randint(0, 9)
+            for i in range(len(stops)):
+                if trips and not overtaking:
+                    minute = max(minute, trips[-1][i])
+                trip.append(minute)
+                minute += rng.randint(1, 30)
+            trips.append(trip)
+        rng.shuffle(trips)
+        routes.append((stops, trips))
+        rows.append({"line": f"L{r}", "mode": "TRAIN", "stops": stops, "trips": trips})
+
+    path = directory / f"timetable_{seed}.json"
+    path.write_text(json.dumps({"routes": rows}))
+    return routes, path
+
+
+def shipped_routes(tt):
+    routes = []
+    for r in range(len(tt.route_lines)):
+        stop_base = tt.route_stop_offsets[r]
+        n_stops = tt.route_stop_offsets[r + 1] - stop_base
+        stops = [tt.ids[p] for p in tt.route_stops[stop_base:stop_base + n_stops]]
+        base = tt.route_time_offsets[r]
+        trips = [list(tt.stop_times[base + t * n_stops: base + (t + 1) * n_stops]) for t in range(tt.route_trip_counts[r])]
+        routes.append((stops, trips))
+    return routes
+
+
+def check_legs(test, journey, a, b):
+    test.assertEqual((journey.legs[0].stops[0], journey.legs[-1].stops[-1]), (a, b))
+    test.assertEqual((journey.departure_minute, journey.arrival_minute), (journey.legs[0].board_minute, journey.legs[-1].alight_minute))
+    for before, after in zip(journey.legs, journey.legs[1:]):
+        test.assertEqual(before.stops[-1], after.stops[0])
+        test.assertLessEqual(before.alight_minute, after.board_minute)
+
+
+def check_window(test, found, routes, a, b, earliest, latest):
+    for journey in found:
+        test.assertTrue(earliest <= journey.departure_minute <= latest, (a, b, journey))
+        check_legs(test, journey, a, b)
+
+    # Leaving at minute d is worth it when it arrives earlier than leaving at d + 1;
+    # every such departure inside the window must be matched by a reported journey
+    arrivals = [
+        reference_arrivals(routes, a, d).get(b, UNREACHED)
+        for d in range(earliest, latest + 2)
+    ]
+    got = {(j.departure_minute, j.arrival_minute) for j in found}
+    for offset in range(latest - earliest + 1):
+        departure, arrival = earliest + offset, arrivals[offset]
+        if arrival < arrivals[offset + 1]:
+            test.assertTrue(
+                any(d >= departure and x <= arrival for d, x in got),
+                (a, b, earliest, latest, departure, arrival, sorted(got)),
+            )
+
+
+class RaptorTests(unittest.TestCase):
+    @classmethod
+    def setUpClass(cls):
+        cls.stations = load_network(DATA_DIR)[0]
+        cls.shipped = load_timetable(DATA_DIR / "timetable.json", cls.stations)
+
+    def check_earliest_arrival(self, tt, routes, queries, seed):
+        rng = random.Random(seed)
+        stops = sorted({sid for route_stops, _ in routes for sid in route_stops})
+        for _ in range(queries):
+            a, b = rng.sample(stops, 2)
+            departure = rng.randint(280, 720)
+            expected = reference_arrivals(routes, a, departure).get(b)
+            journey = raptor_earliest_arrival(tt, a, b, departure, max_transfers = 10)
+            self.assertEqual(journey.arrival_minute if journey else None, expected, (a, b, departure))
+            if journey:
+                self.assertGreaterEqual(journey.departure_minute, departure)
+                check_legs(self, journey, a, b)
+
+    def test_earliest_arrival_shipped_timetable(self):
+        self.check_earliest_arrival(self.shipped, shipped_routes(self.shipped), 200, seed = 1)
+
+    def test_earliest_arrival_with_overtaking_trips(self):
+        for seed in range(4):
+            routes, path = random_timetable(self.stations, seed, overtaking = True, directory = temp_dir(self))
+            tt = load_timetable(path, self.stations)
+            self.check_earliest_arrival(tt, routes, 100, seed)
+
+    def test_trip_going_back_in_time_is_rejected(self):
+        path = temp_dir(self) / "timetable.json"
+        path.write_text(json.dumps({"routes": [{"line": "X", "stops": ["WFR", "BRD"], "trips": [[300, 290]]}]}))
+        with self.assertRaises(ValueError):
+            load_timetable(path, self.stations)
+
+    def check_range(self, tt, routes, a, b, earliest, latest):
+        found = raptor_range_query(tt, a, b, earliest, latest, max_transfers = 10)
+        check_window(self, found, routes, a, b, earliest, latest)
+
+    def test_range_query_stays_inside_window(self):
+        self.check_range(self.shipped, shipped_routes(self.shipped), "BRD", "CMB", 420, 540)
+        rng = random.Random(3)
+        for _ in range(40):
+            a, b = rng.sample(sorted(self.stations), 2)
+            self.check_range(self.shipped, shipped_routes(self.shipped), a, b, 420, 480)
+
+    def test_range_query_random_timetables(self):
+        for seed in range(3):
+            routes, path = random_timetable(self.stations, seed, overtaking = seed % 2 == 1, directory = temp_dir(self))
+            tt = load_timetable(path, self.stations)
+            stops = sorted({sid for route_stops, _ in routes for sid in route_stops})
+            rng = random.Random(seed)
+            for _ in range(15):
+                a, b = rng.sample(stops, 2)
+                self.check_range(tt, routes, a, b, 400, 560)
+
+
+class ConnectionScanTests(unittest.TestCase):
+    @classmethod
+    def setUpClass(cls):
+        cls.stations, cls.graph = load_network(DATA_DIR)[:2]
+        cls.shipped = load_timetable(DATA_DIR / "timetable.json", cls.stations)
+
+    def test_earliest_arrival_matches_raptor(self):
+        for seed, tt in enumerate([self.shipped] + [
+            load_timetable(random_timetable(self.stations, seed, overtaking = True, directory = temp_dir(self))[1], self.stations)
+            for seed in range(3)
+        ]):
+            ct = build_connections(tt)
+            rng = random.Random(seed)
+            for _ in range(150):
+                a, b = rng.sample(sorted(self.stations), 2)
+                departure = rng.randint(280, 720)
+                for transfer in (0, 3):
+                    csa = csa_earliest_arrival(ct, a, b, departure, transfer)
+                    raptor = raptor_earliest_arrival(tt, a, b, departure, max_transfers = 10, min_transfer_minutes = transfer)
+                    self.assertEqual(
+                        csa.arrival_minute if csa else None,
+                        raptor.arrival_minute if raptor else None,
+                        (seed, a, b, departure, transfer),
+                    )
+                    if csa:
+                        check_legs(self, csa, a, b)
+
+    def test_earliest_arrival_does_not_loop_through_origin(self):
+        ct = build_connections(timetable_from_network(self.graph, headway_minutes = 7))
+        journey = csa_earliest_arrival(ct, "GCT", "KGT", 538)
+        self.assertEqual(journey.departure_minute, 544)
+        self.assertEqual(len(journey.legs), 1)
+
+    def test_profile_keeps_departure_whose_trip_is_also_caught_later(self):
+        # Leaving at 536 and changing at BRD reaches GCT on the same trip that also
+        # stops at WFR itself at 582, after the window
+        path = temp_dir(self) / "timetable.json"
+        path.write_text(json.dumps({"routes": [
+            {"line": "A", "stops": ["WFR", "BRD"], "trips": [[536, 550]]},
+            {"line": "B", "stops": ["WFR", "BRD", "GCT"], "trips": [[582, 650, 696]]},
+        ]}))
+        ct = build_connections(load_timetable(path, self.stations))
+        found = csa_profile(ct, "WFR", "GCT", 400, 560)
+        self.assertEqual([(j.departure_minute, j.arrival_minute) for j in found], [(536, 696)])
+        self.assertEqual([leg.line for leg in found[0].legs], ["A", "B"])
+
+    def test_profile_window(self):
+        routes = shipped_routes(self.shipped)
+        ct = build_connections(self.shipped)
+        rng = random.Random(5)
+        for _ in range(30):
+            a, b = rng.sample(sorted(self.stations), 2)
+            check_window(self, csa_profile(ct, a, b, 420, 480), routes, a, b, 420, 480)
+
+        for seed in range(4):
+            routes, path = random_timetable(self.stations, seed, overtaking = seed % 2 == 1, directory = temp_dir(self))
+            ct = build_connections(load_timetable(path, self.stations))
+            stops = sorted({sid for route_stops, _ in routes for sid in route_stops})
+            rng = random.Random(seed)
+            for _ in range(15):
+                a, b = rng.sample(stops, 2)
+                check_window(self, csa_profile(ct, a, b, 400, 560), routes, a, b, 400, 560)
+
+
+if __name__ == "__main__":
+    unittest.main()